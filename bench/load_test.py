@@ -0,0 +1,303 @@
+"""Нагрузочный тест бота против локального поддельного Bot API.
+
+Настоящий Application из bot.py работает в режиме long polling, но ходит
+не в api.telegram.org, а в HTTP-сервер на localhost в отдельном процессе.
+Сервер раздает через getUpdates апдейты синтетических пользователей и принимает sendMessage, editMessageText и answerCallbackQuery.
+Пользователи приходят с заданной частотой и нажимают следующую кнопку, только
+когда бот ответил на предыдущую (и прошло время «на подумать»).
+
+Задержка шага — от выдачи апдейта в getUpdates до ответа бота на него.
+Отставание event loop бота замеряется отдельной задачей-таймером.
+
+Примеры:
+    python bench/load_test.py --users 500 --rate 50
+    python bench/load_test.py --users 2000 --rate 200 --think 0.5 --output report.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import multiprocessing
+import time
+from urllib.parse import parse_qsl
+
+import tornado.httpserver
+import tornado.web
+from telegram.ext import Application
+
+from offline import (
+    STEP_NAMES, TEST_TOKEN, UpdateFactory, fake_api_result, latency_summary,
+)
+
+import bot
+from database import DB_READ_ONLY, init_db
+from update_filters import allowed_updates_for
+
+# Методы, ответ на которые означает, что бот закончил обработку шага пользователя
+REPLY_METHODS = ("sendMessage", "editMessageText")
+# Период таймера, по которому меряется отставание event loop бота
+LAG_INTERVAL = 0.05
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест с поддельным Bot API")
+    parser.add_argument("--users", type=int, default=200, help="сколько пользователей проходят квиз")
+    parser.add_argument("--rate", type=float, default=20.0, help="новых пользователей в секунду")
+    parser.add_argument("--think", type=float, default=0.0, help="пауза пользователя между шагами, с")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8788)
+    parser.add_argument("--timeout", type=float, default=120.0, help="предел времени всего теста, с")
+    parser.add_argument("--output", help="записать отчет в JSON-файл")
+    parser.add_argument("--json", action="store_true", help="вывести отчет в JSON")
+    return parser.parse_args()
+
+
+class QuizUser:
+    """Синтетический пользователь: заранее построенный квиз и время выдачи текущего шага."""
+
+    def __init__(self, flow):
+        self.flow = flow
+        self.step = 0
+        self.sent_at = None
+        self.started_at = None
+        self.finished_at = None
+
+
+class FakeTelegram:
+    """Сторона Telegram: очередь getUpdates, пользователи и замеры по шагам.
+
+    Все методы вызываются в потоке сервера, в его event loop.
+    """
+
+    def __init__(self, args, flows):
+        self.args = args
+        self.users = {flow[0]["message"]["from"]["id"]: QuizUser(flow) for flow in flows}
+        self.updates = asyncio.Queue()
+        self.step_latency = {name: [] for name in STEP_NAMES}
+        self.calls = {}
+        self.completed = 0
+        self.done = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def send_step(self, user):
+        update = dict(user.flow[user.step], update_id=next(self._update_ids))
+        user.sent_at = time.perf_counter()
+        if user.started_at is None:
+            user.started_at = user.sent_at
+        self.updates.put_nowait(update)
+
+    async def arrivals(self):
+        rng = random.Random(self.args.seed)
+        for user in self.users.values():
+            self.send_step(user)
+            if self.args.rate > 0:
+                # пуассоновский поток прихода пользователей
+                await asyncio.sleep(rng.expovariate(self.args.rate))
+
+    async def next_step(self, user):
+        if self.args.think > 0:
+            await asyncio.sleep(self.args.think)
+        self.send_step(user)
+
+    def on_reply(self, chat_id):
+        user = self.users.get(chat_id)
+        if user is None or user.sent_at is None:
+            return
+        self.step_latency[STEP_NAMES[user.step]].append(time.perf_counter() - user.sent_at)
+        user.sent_at = None
+        user.step += 1
+        if user.step < len(user.flow):
+            asyncio.get_running_loop().create_task(self.next_step(user))
+            return
+        user.finished_at = time.perf_counter()
+        self.completed += 1
+        if self.completed == len(self.users):
+            self.done.set()
+
+    def report(self, elapsed, timed_out):
+        durations = [
+            user.finished_at - user.started_at
+            for user in self.users.values() if user.finished_at is not None
+        ]
+        return {
+            "completed": self.completed,
+            "timed_out": timed_out,
+            "elapsed_s": round(elapsed, 3),
+            "quizzes_per_s": round(self.completed / elapsed, 2) if elapsed else 0.0,
+            "quiz_duration": latency_summary(durations),
+            "steps": {name: latency_summary(values) for name, values in self.step_latency.items()},
+            "api_calls": self.calls,
+        }
+
+    async def get_updates(self, params):
+        timeout = float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+        batch = []
+        try:
+            batch.append(await asyncio.wait_for(self.updates.get(), timeout or 0.001))
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # пустой ответ long polling или бот закрыл соединение при остановке
+            return batch
+        while len(batch) < limit and not self.updates.empty():
+            batch.append(self.updates.get_nowait())
+        return batch
+
+    async def call(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getUpdates":
+            return await self.get_updates(params)
+        if self.args.api_latency > 0:
+            await asyncio.sleep(self.args.api_latency)
+        if method in REPLY_METHODS:
+            self.on_reply(int(params["chat_id"]))
+        if "chat_id" in params:
+            params["chat_id"] = int(params["chat_id"])
+        if "message_id" in params:
+            params["message_id"] = int(params["message_id"])
+        return fake_api_result(method, params, self._message_ids)
+
+
+class BotApiHandler(tornado.web.RequestHandler):
+    def initialize(self, telegram):
+        self.telegram = telegram
+
+    async def post(self, token, method):
+        body = self.request.body.decode("utf-8")
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(body or "{}")
+        else:
+            params = dict(parse_qsl(body))
+        result = await self.telegram.call(method, params)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({"ok": True, "result": result}, ensure_ascii=False))
+
+
+class FakeTelegramServer(multiprocessing.Process):
+    """HTTP-сервер поддельного Bot API в отдельном процессе, чтобы он не отнимал
+    процессорное время у бота. Управляется через pipe: "start" запускает
+    пользователей, в ответ приходит отчет; "stop" останавливает сервер."""
+
+    def __init__(self, args, flows):
+        super().__init__(daemon=True)
+        self.args = args
+        self.flows = flows
+        self.conn, self._child_conn = multiprocessing.Pipe()
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        telegram = FakeTelegram(self.args, self.flows)
+        app = tornado.web.Application(
+            [(r"/bot([^/]+)/(\w+)", BotApiHandler, {"telegram": telegram})]
+        )
+        server = tornado.httpserver.HTTPServer(app)
+        server.listen(self.args.port, "127.0.0.1")
+        self._child_conn.send("ready")
+
+        await loop.run_in_executor(None, self._child_conn.recv)
+        started = time.perf_counter()
+        loop.create_task(telegram.arrivals())
+        timed_out = False
+        try:
+            await asyncio.wait_for(telegram.done.wait(), self.args.timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+        self._child_conn.send(telegram.report(time.perf_counter() - started, timed_out))
+
+        # сервер отвечает боту, пока тот не остановится
+        await loop.run_in_executor(None, self._child_conn.recv)
+        server.stop()
+
+
+async def measure_loop_lag(samples, stop):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        samples.append(max(0.0, time.perf_counter() - started - LAG_INTERVAL))
+
+
+async def run(args, flows):
+    server = FakeTelegramServer(args, flows)
+    server.start()
+    await asyncio.to_thread(server.conn.recv)
+
+    builder = (
+        Application.builder()
+        .token(TEST_TOKEN)
+        .base_url(f"http://127.0.0.1:{args.port}/bot")
+        .base_file_url(f"http://127.0.0.1:{args.port}/file/bot")
+    )
+    application = bot.build_application(builder)
+
+    lag = []
+    stop_lag = asyncio.Event()
+
+    await application.initialize()
+    await application.start()
+    await application.updater.start_polling(
+        poll_interval=0.0, timeout=1, allowed_updates=allowed_updates_for(application)
+    )
+    lag_task = asyncio.create_task(measure_loop_lag(lag, stop_lag))
+
+    server.conn.send("start")
+    report = await asyncio.to_thread(server.conn.recv)
+
+    stop_lag.set()
+    await lag_task
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    server.conn.send("stop")
+    server.join(timeout=5)
+
+    processor = application.update_processor
+    report["config"] = {
+        "users": args.users,
+        "rate": args.rate,
+        "think_s": args.think,
+        "api_latency_s": args.api_latency,
+        "quiz_mode": bot.QUIZ_MODE,
+        "recommender_engine": bot.RECOMMENDER_ENGINE,
+        "max_concurrent_updates": processor.max_concurrent_updates,
+    }
+    report["event_loop_lag"] = latency_summary(lag)
+    return report
+
+
+def build_flows(args):
+    factory = UpdateFactory()
+    rng = random.Random(args.seed)
+    stateless = bot.QUIZ_MODE == "stateless"
+    return [factory.quiz_flow(index, rng, stateless) for index in range(args.users)]
+
+
+def main():
+    args = parse_args()
+    if not DB_READ_ONLY:
+        init_db()
+    bot.setup_recommender()
+    report = asyncio.run(run(args, build_flows(args)))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    print(f"Пользователей: {args.users}, квиз прошли: {report['completed']}"
+          + (" (тест прерван по --timeout)" if report["timed_out"] else ""))
+    print(f"Время: {report['elapsed_s']} с, {report['quizzes_per_s']} квизов/с")
+    for name, summary in report["steps"].items():
+        print(f"  {name}: p50 {summary['p50_ms']} мс, p99 {summary['p99_ms']} мс")
+    lag = report["event_loop_lag"]
+    print(f"Отставание event loop: p50 {lag['p50_ms']} мс, p99 {lag['p99_ms']} мс, max {lag['max_ms']} мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""Микробенчмарки горячих путей: загрузка каталога, подбор и текст результата.
+
+Каждый размер каталога прогоняется в отдельном процессе со своей базой:
+синтетический каталог (по схеме data/*.json) пишется в NDJSON, грузится через
+load_json_data, затем меряются подбор из готовой таблицы, запрос с каскадом,
+худший случай (совпал только тон кожи), движок в памяти и сборка текста.
+
+Для каждого замера: время, число SQL-запросов, пик выделенной памяти
+(tracemalloc, отдельным прогоном) и пиковый RSS процесса к концу замера.
+
+Примеры:
+    python bench/micro.py                                   # SQLite, 100 и 10k продуктов
+    python bench/micro.py --sizes 100,10000,1000000 --output report.json
+    python bench/micro.py --database-url postgresql://localhost/beautymatch
+    python bench/micro.py --compare bench/baseline_sqlite.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT = BENCH_DIR.parent
+DATA_DIR = ROOT / "data"
+
+# Отдельная схема PostgreSQL: бенчмарк пересоздает ее и не трогает рабочие таблицы
+PG_SCHEMA = "beautymatch_bench"
+# Сколько наборов ответов прогоняется в каждом замере подбора
+SAMPLE_ANSWERS = 300
+# Запрос с каскадом растет с размером каталога: на больших каталогах наборов меньше
+RANKED_BUDGET = 1_000_000
+# Значение, которого нет в каталоге: каскад останавливается на тоне кожи
+MISSING_VALUE = "нет такого"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Микробенчмарки подбора и загрузки каталога")
+    parser.add_argument("--sizes", default="100,10000", help="размеры каталога через запятую")
+    parser.add_argument("--database-url", help="PostgreSQL вместо временного файла SQLite")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="повторов замера, берется лучший")
+    parser.add_argument("--no-alloc", action="store_true", help="не мерить память через tracemalloc")
+    parser.add_argument("--output", help="записать отчет в JSON-файл")
+    parser.add_argument("--compare", help="сравнить с сохраненным отчетом (например, baseline)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимое замедление, доля")
+    parser.add_argument("--worker-size", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def rss_mb():
+    # ru_maxrss в Linux — в КиБ
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def generate_catalog(size: int, seed: int, directory: Path):
+    """Пишет size продуктов, поровну по категориям, в NDJSON-файлы; возвращает [(файл, категория)]."""
+    from recommendations import ANSWER_FIELDS, ANSWER_SPACE
+
+    rng = random.Random(seed)
+    files = []
+    categories = sorted(path.stem for path in DATA_DIR.glob("*.json"))
+    for position, category in enumerate(categories):
+        samples = json.loads((DATA_DIR / f"{category}.json").read_text(encoding="utf-8"))
+        count = size // len(categories) + (1 if position < size % len(categories) else 0)
+        path = directory / f"{category}.ndjson"
+        with open(path, "w", encoding="utf-8") as f:
+            for number in range(count):
+                sample = samples[number % len(samples)]
+                product = {
+                    "name": f"{sample['name']} {number}",
+                    "brand": sample["brand"],
+                    "color": sample["color"],
+                    "price": round(rng.uniform(300, 5000)),
+                    "description": sample.get("description", ""),
+                    "image_url": sample.get("image_url", ""),
+                }
+                for field in ANSWER_FIELDS:
+                    values = [value for value in ANSWER_SPACE[field] if rng.random() < 0.4]
+                    product[field] = values or [rng.choice(ANSWER_SPACE[field])]
+                f.write(json.dumps(product, ensure_ascii=False) + "\n")
+        files.append((path, category))
+    return files
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def measure(name, func, counter, repeat, trace_alloc, ops=1):
+    """Лучшее время из repeat прогонов, запросы за один прогон и пик памяти."""
+    best = None
+    queries = 0
+    for _ in range(repeat):
+        before = counter.count
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        queries = counter.count - before
+        best = elapsed if best is None else min(best, elapsed)
+
+    result = {
+        "wall_s": round(best, 6),
+        "per_op_us": round(best / ops * 1e6, 2),
+        "ops": ops,
+        "queries": queries,
+    }
+    if trace_alloc:
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["alloc_peak_kb"] = round(peak / 1024, 1)
+    result["peak_rss_mb"] = rss_mb()
+    print(f"  {name}: {result['wall_s']} с, {result['queries']} запросов", file=sys.stderr)
+    return result
+
+
+def prepare_database(database_url):
+    """DATABASE_URL для процесса замера; схему PostgreSQL пересоздает заново."""
+    if not database_url:
+        directory = tempfile.mkdtemp(prefix="beautymatch-bench-")
+        return f"sqlite:///{directory}/bench.db"
+
+    from sqlalchemy import create_engine, text
+
+    admin = create_engine(database_url)
+    with admin.begin() as conn:
+        conn.execute(text(f"DROP SCHEMA IF EXISTS {PG_SCHEMA} CASCADE"))
+        conn.execute(text(f"CREATE SCHEMA {PG_SCHEMA}"))
+    admin.dispose()
+    separator = "&" if "?" in database_url else "?"
+    return f"{database_url}{separator}options=-csearch_path%3D{PG_SCHEMA}"
+
+
+def run_worker(args):
+    """Все замеры для одного размера каталога; вызывается в отдельном процессе."""
+    sys.path.insert(0, str(ROOT))
+    from database import engine, init_db
+
+    counter = QueryCounter(engine)
+    init_db()
+    directory = Path(tempfile.mkdtemp(prefix="beautymatch-feed-"))
+    try:
+        return _run_benchmarks(args, directory, counter)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _run_benchmarks(args, directory, counter):
+    from itertools import product as cartesian_product
+
+    import load_data
+    from catalog_engine import MemoryCatalogEngine, load_catalog
+    from database import SessionLocal, engine
+    from handlers import format_result
+    from recommendations import (
+        ANSWER_FIELDS, ANSWER_SPACE, _query_ranked, build_recommendation_table,
+        get_products_by_preferences,
+    )
+
+    size = args.worker_size
+    repeat = args.repeat
+    trace_alloc = not args.no_alloc
+    results = {}
+    files = generate_catalog(size, args.seed, directory)
+
+    def load():
+        for path, category in files:
+            load_data.load_json_data(str(path), category, force=True)
+
+    # загрузка идет один раз: повторная — это уже обновление без изменений
+    with contextlib.redirect_stdout(sys.stderr):
+        results["load"] = measure("load", load, counter, 1, False, ops=size)
+        results["reload_unchanged"] = measure("reload_unchanged", load, counter, 1, False, ops=size)
+
+    def precompute():
+        db = SessionLocal()
+        try:
+            build_recommendation_table(db)
+        finally:
+            db.close()
+
+    results["precompute"] = measure("precompute", precompute, counter, 1, False)
+
+    rng = random.Random(args.seed)
+    space = list(cartesian_product(*(ANSWER_SPACE[field] for field in ANSWER_FIELDS)))
+    sample = rng.sample(space, min(SAMPLE_ANSWERS, len(space)))
+    ranked_sample = sample[:max(10, min(len(sample), RANKED_BUDGET // max(size, 1)))]
+    skin_only = [(answers[0], MISSING_VALUE) + answers[2:] for answers in ranked_sample]
+
+    def lookup(answer_sets):
+        return lambda: [get_products_by_preferences(*answers) for answers in answer_sets]
+
+    def ranked():
+        with engine.connect() as conn:
+            for answers in ranked_sample:
+                _query_ranked(conn, *answers)
+
+    ops = len(sample)
+    results["lookup_precomputed"] = measure("lookup_precomputed", lookup(sample), counter, repeat, trace_alloc, ops)
+    results["lookup_ranked"] = measure(
+        "lookup_ranked", ranked, counter, repeat, trace_alloc, len(ranked_sample)
+    )
+    # худший случай: готовой подборки нет, и каскад доходит только до тона кожи
+    results["lookup_skin_only"] = measure(
+        "lookup_skin_only", lookup(skin_only), counter, repeat, trace_alloc, len(skin_only)
+    )
+
+    results["memory_load"] = measure("memory_load", load_catalog, counter, 1, trace_alloc)
+    memory_engine = MemoryCatalogEngine()
+    results["memory_recommend"] = measure(
+        "memory_recommend",
+        lambda: [memory_engine.recommend(*answers) for answers in sample],
+        counter, repeat, trace_alloc, ops,
+    )
+
+    # тексты результата в порядке вопросов квиза: глаза, кожа, волосы, лицо, повод
+    rendered = [
+        ((answers[1], answers[0], answers[2], answers[3], answers[4]), get_products_by_preferences(*answers))
+        for answers in sample
+    ]
+    results["render"] = measure(
+        "render",
+        lambda: [format_result(answers, recommendations) for answers, recommendations in rendered],
+        counter, repeat, trace_alloc, ops,
+    )
+    return results
+
+
+def run_size(args, size):
+    database_url = prepare_database(args.database_url)
+    env = dict(os.environ, DATABASE_URL=database_url)
+    command = [
+        sys.executable, __file__, "--worker-size", str(size),
+        "--seed", str(args.seed), "--repeat", str(args.repeat),
+    ]
+    if args.no_alloc:
+        command.append("--no-alloc")
+    print(f"Каталог {size} продуктов...", file=sys.stderr)
+    try:
+        output = subprocess.run(command, env=env, check=True, stdout=subprocess.PIPE, text=True).stdout
+    finally:
+        if not args.database_url:
+            shutil.rmtree(Path(database_url[len("sqlite:///"):]).parent, ignore_errors=True)
+    return json.loads(output)
+
+
+def compare(report, baseline, tolerance):
+    """Строки сравнения с baseline и число замеров, замедлившихся сильнее tolerance."""
+    lines = []
+    regressions = 0
+    for size, benchmarks in report["results"].items():
+        for name, result in benchmarks.items():
+            base = baseline.get("results", {}).get(size, {}).get(name)
+            if not base or not base["wall_s"]:
+                continue
+            ratio = result["wall_s"] / base["wall_s"]
+            mark = ""
+            if ratio > 1 + tolerance:
+                mark = "  <- медленнее"
+                regressions += 1
+            elif result["queries"] > base["queries"]:
+                mark = "  <- больше запросов"
+                regressions += 1
+            lines.append(
+                f"{size:>8} {name:<20} {base['wall_s']:>10.4f} -> {result['wall_s']:>10.4f} с"
+                f"  x{ratio:.2f}  запросов {base['queries']} -> {result['queries']}{mark}"
+            )
+    return lines, regressions
+
+
+def main():
+    args = parse_args()
+    if args.worker_size is not None:
+        print(json.dumps(run_worker(args)))
+        return
+
+    import sqlalchemy
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    dialect = args.database_url.split(":", 1)[0] if args.database_url else "sqlite"
+    report = {
+        "meta": {
+            "dialect": dialect,
+            "python": platform.python_version(),
+            "sqlalchemy": sqlalchemy.__version__,
+            "machine": platform.machine(),
+            "seed": args.seed,
+            "repeat": args.repeat,
+        },
+        "results": {str(size): run_size(args, size) for size in sizes},
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        lines, regressions = compare(report, baseline, args.tolerance)
+        print("\n".join(lines))
+        print(f"Замедлений сверх {args.tolerance:.0%}: {regressions}")
+        sys.exit(1 if regressions else 0)
+
+    if not args.output:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
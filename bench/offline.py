@@ -0,0 +1,184 @@
+"""Общие части стендов: бот без сети и синтетические апдейты квиза."""
+import itertools
+import json
+import random
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+from telegram.request import BaseRequest
+
+# стенды лежат в bench/, а модули бота — в корне проекта
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from recommendations import EYE_COLORS, SKIN_TONES, HAIR_COLORS, FACE_SHAPES, OCCASIONS  # noqa: E402
+
+TEST_TOKEN = "123456:OFFLINE-TEST-TOKEN"
+
+BOT_USER = {
+    "id": 123456,
+    "is_bot": True,
+    "first_name": "BeautyMatch",
+    "username": "beautymatch_test_bot",
+}
+
+# Шаги квиза: префикс callback_data и варианты ответа
+QUIZ_STEPS = [
+    ("eye", EYE_COLORS),
+    ("skin", SKIN_TONES),
+    ("hair", HAIR_COLORS),
+    ("face", FACE_SHAPES),
+    ("occasion", OCCASIONS),
+]
+STEP_NAMES = ["quiz"] + [prefix for prefix, _ in QUIZ_STEPS]
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def latency_summary(seconds):
+    return {
+        "count": len(seconds),
+        "p50_ms": round(percentile(seconds, 50) * 1000, 3),
+        "p90_ms": round(percentile(seconds, 90) * 1000, 3),
+        "p99_ms": round(percentile(seconds, 99) * 1000, 3),
+        "max_ms": round(max(seconds, default=0.0) * 1000, 3),
+    }
+
+
+def fake_api_result(method, params, message_ids):
+    """Ответ Bot API на вызов method, достаточный для обработчиков бота."""
+    if method == "getMe":
+        return BOT_USER
+    if method == "getUpdates":
+        return []
+    if method in ("sendMessage", "editMessageText"):
+        message_id = params.get("message_id") or next(message_ids)
+        chat_id = params.get("chat_id", 0)
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+    return True
+
+
+class OfflineRequest(BaseRequest):
+    """Запросы к Bot API, которые не выходят в сеть и сразу получают ответ."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        params = request_data.parameters if request_data else {}
+        result = fake_api_result(api_method, params, self._message_ids)
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+
+class UpdateFactory:
+    """Строит JSON апдейтов Telegram для синтетических пользователей квиза."""
+
+    def __init__(self, first_user_id: int = 10_000):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1_000_000)
+        self.first_user_id = first_user_id
+
+    def user(self, index: int):
+        user_id = self.first_user_id + index
+        return {"id": user_id, "is_bot": False, "first_name": f"User{index}"}
+
+    def command(self, user, command: str):
+        text = f"/{command}"
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user["id"], "type": "private"},
+                "from": user,
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+            },
+        }
+
+    def callback(self, user, data: str, message_id: int):
+        update_id = next(self._update_ids)
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": user,
+                "chat_instance": str(user["id"]),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user["id"], "type": "private"},
+                    "from": BOT_USER,
+                    "text": "...",
+                },
+            },
+        }
+
+    def quiz_flow(self, index: int, rng: random.Random, stateless: bool = False):
+        """/quiz и пять нажатий кнопок одного пользователя.
+
+        stateless=True — callback_data в формате QUIZ_MODE=stateless ("q:<индексы>").
+        """
+        user = self.user(index)
+        message_id = next(self._message_ids)
+        updates = [self.command(user, "quiz")]
+        digits = ""
+        for prefix, options in QUIZ_STEPS:
+            choice = rng.randrange(len(options))
+            digits += str(choice)
+            data = f"q:{digits}" if stateless else f"{prefix}_{options[choice]}"
+            updates.append(self.callback(user, data, message_id))
+        return updates
+
+
+def update_user_id(update):
+    for key in ("message", "callback_query"):
+        if key in update:
+            return update[key]["from"]["id"]
+    return None
+
+
+def update_step(update):
+    if "message" in update:
+        words = update["message"].get("text", "").lstrip("/").split()
+        return words[0] if words else "message"
+    data = update.get("callback_query", {}).get("data", "")
+    if data.startswith("q:"):
+        return STEP_NAMES[len(data) - 2]
+    return data.split("_", 1)[0] or "callback"
+
+
+def load_updates(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def group_by_user(updates):
+    flows = {}
+    for update in updates:
+        flows.setdefault(update_user_id(update), []).append(update)
+    return list(flows.values())
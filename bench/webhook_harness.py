@@ -0,0 +1,172 @@
+"""Стенд для режима webhook без связи с Telegram.
+
+Поднимает настоящий Application из bot.py с webhook-сервером на localhost,
+отвечает на вызовы Bot API локально (OfflineRequest) и отправляет на
+эндпоинт записанные или синтетические апдейты. Апдейты одного пользователя
+идут строго по очереди, разные пользователи — параллельно.
+
+Примеры:
+    python bench/webhook_harness.py --users 200 --concurrency 50
+    python bench/webhook_harness.py --users 20 --record updates.jsonl
+    python bench/webhook_harness.py --updates updates.jsonl --json
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import httpx
+from telegram.ext import Application
+
+from offline import (
+    TEST_TOKEN, OfflineRequest, UpdateFactory, group_by_user, latency_summary,
+    load_updates, update_step,
+)
+
+import bot
+from database import DB_READ_ONLY, init_db
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд webhook-режима")
+    parser.add_argument("--updates", help="JSONL с записанными апдейтами Telegram")
+    parser.add_argument("--users", type=int, default=100, help="синтетических пользователей без --updates")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--record", help="сохранить отправляемые апдейты в JSONL")
+    parser.add_argument("--concurrency", type=int, default=32, help="пользователей одновременно")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--path", default="telegram")
+    parser.add_argument("--secret", default="harness-secret")
+    parser.add_argument("--timeout", type=float, default=30.0, help="ожидание обработки одного апдейта, с")
+    parser.add_argument("--json", action="store_true", help="вывести отчет в JSON")
+    return parser.parse_args()
+
+
+def build_flows(args):
+    if args.updates:
+        return group_by_user(load_updates(args.updates))
+
+    factory = UpdateFactory()
+    rng = random.Random(args.seed)
+    stateless = bot.QUIZ_MODE == "stateless"
+    flows = [factory.quiz_flow(index, rng, stateless) for index in range(args.users)]
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as f:
+            for flow in flows:
+                for update in flow:
+                    f.write(json.dumps(update, ensure_ascii=False) + "\n")
+    return flows
+
+
+async def run(args):
+    flows = build_flows(args)
+    api = OfflineRequest()
+    builder = Application.builder().token(TEST_TOKEN).request(api).get_updates_request(OfflineRequest())
+    application = bot.build_application(builder)
+
+    # обработка апдейта считается завершенной, когда process_update вернул управление
+    pending = {}
+    process_update = application.process_update
+
+    async def timed_process_update(update):
+        try:
+            await process_update(update)
+        finally:
+            future = pending.pop(update.update_id, None)
+            if future is not None and not future.done():
+                future.set_result(time.perf_counter())
+
+    application.process_update = timed_process_update
+
+    url = f"http://127.0.0.1:{args.port}/{args.path}"
+    http_latency = []
+    handler_latency = []
+    step_latency = {}
+    failures = 0
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def play(client, flow):
+        nonlocal failures
+        async with slots:
+            for update in flow:
+                done = asyncio.get_running_loop().create_future()
+                pending[update["update_id"]] = done
+                started = time.perf_counter()
+                response = await client.post(url, json=update, headers={SECRET_HEADER: args.secret})
+                http_latency.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    failures += 1
+                    pending.pop(update["update_id"], None)
+                    continue
+                try:
+                    finished = await asyncio.wait_for(done, args.timeout)
+                except asyncio.TimeoutError:
+                    failures += 1
+                    pending.pop(update["update_id"], None)
+                    continue
+                handler_latency.append(finished - started)
+                step_latency.setdefault(update_step(update), []).append(finished - started)
+
+    await application.initialize()
+    await application.start()
+    await application.updater.start_webhook(
+        listen="127.0.0.1",
+        port=args.port,
+        url_path=args.path,
+        webhook_url=url,
+        secret_token=args.secret,
+    )
+
+    try:
+        async with httpx.AsyncClient(timeout=args.timeout) as client:
+            # без правильного секрета эндпоинт должен отвечать 403
+            rejected = await client.post(url, json={"update_id": 0}, headers={SECRET_HEADER: "wrong"})
+            started = time.perf_counter()
+            await asyncio.gather(*(play(client, flow) for flow in flows))
+            elapsed = time.perf_counter() - started
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+
+    updates = sum(len(flow) for flow in flows)
+    return {
+        "users": len(flows),
+        "updates": updates,
+        "failures": failures,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(updates / elapsed, 1) if elapsed else 0.0,
+        "secret_check": "ok" if rejected.status_code == 403 else f"unexpected {rejected.status_code}",
+        "http": latency_summary(http_latency),
+        "handler": latency_summary(handler_latency),
+        "steps": {step: latency_summary(values) for step, values in step_latency.items()},
+        "api_calls": dict(api.calls),
+    }
+
+
+def main():
+    args = parse_args()
+    if not DB_READ_ONLY:
+        init_db()
+    bot.setup_recommender()
+    report = asyncio.run(run(args))
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    print(f"Пользователей: {report['users']}, апдейтов: {report['updates']}, ошибок: {report['failures']}")
+    print(f"Время: {report['elapsed_s']} с, {report['updates_per_s']} апдейтов/с")
+    print(f"Проверка секрета: {report['secret_check']}")
+    for name in ("http", "handler"):
+        summary = report[name]
+        print(f"{name}: p50 {summary['p50_ms']} мс, p99 {summary['p99_ms']} мс")
+    for step, summary in report["steps"].items():
+        print(f"  {step}: p50 {summary['p50_ms']} мс, p99 {summary['p99_ms']} мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,9 @@
+import time
+
+# Отсчет времени запуска — до остальных импортов, они занимают большую его часть
+STARTED = time.perf_counter()
+
+import asyncio
 import logging
 import os
 from telegram import Update
@@ -6,24 +12,31 @@ from telegram.ext import (
     CommandHandler,
     CallbackQueryHandler,
     ConversationHandler,
+    TypeHandler,
+    filters,
 )
 from dotenv import load_dotenv
 
-from database import init_db
+import metrics
+import recommendations
+from recommendations import (
+    catalog_watcher, recommendation_cache, recommendation_executor, set_recommender,
+    warm_up_database,
+)
+from update_filters import allowed_updates_for, drop_stale_updates, drop_stats, limit_updates
+from persistence import build_persistence
+from profiler import ADMIN_IDS, profile_command, profiler
+from update_processor import UPDATE_CONCURRENCY, ChatOrderedUpdateProcessor
 from handlers import (
+    result_cache,
     start,
     quiz_start,
-    handle_eye_color,
-    handle_skin_tone,
-    handle_hair_color,
-    handle_face_shape,
-    handle_occasion,
+    handle_answer,
+    stateless_quiz_start,
+    handle_stateless_answer,
     cancel,
-    EYE_COLOR,
-    SKIN_TONE,
-    HAIR_COLOR,
-    FACE_SHAPE,
-    OCCASION,
+    QUESTIONS,
+    STATELESS_PATTERN,
 )
 
 load_dotenv()
@@ -34,32 +47,222 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+class StartupTimer:
+    """Длительность этапов запуска, начиная с импорта bot.py."""
+
+    def __init__(self, started: float):
+        self.started = started
+        self.phases = []
+        self._last = started
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def summary(self):
+        phases = ", ".join(f"{phase} {seconds:.3f}" for phase, seconds in self.phases)
+        return f"{self._last - self.started:.3f} с ({phases})"
+
+
+startup_timer = StartupTimer(STARTED)
+startup_timer.mark("импорт")
+
+# main() ставит True, если каталог прочитан из снимка: базу тогда не прогреваем
+catalog_from_snapshot = False
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# database — подбор запросом к базе, memory — каталог в памяти (catalog_engine.py)
+RECOMMENDER_ENGINE = os.getenv("RECOMMENDER_ENGINE", "database")
 
+# conversation — ответы квиза хранятся на сервере (ConversationHandler + user_data),
+# stateless — все ответы закодированы в callback_data кнопок
+QUIZ_MODE = os.getenv("QUIZ_MODE", "conversation")
 
-def main():
-    init_db()
-    application = Application.builder().token(BOT_TOKEN).build()
+# polling — long polling, webhook — встроенный HTTP-сервер (нужен python-telegram-bot[webhooks])
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# Публичный HTTPS-адрес (например, https://bot.example.com), который регистрируется
+# в Telegram; в режиме webhook обязателен — адрес, собранный python-telegram-bot из
+# WEBHOOK_LISTEN и WEBHOOK_PORT (https://0.0.0.0:8443/...), Telegram не примет
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# Метрики (METRICS_PORT, METRICS_DUMP_INTERVAL — см. metrics.py): SQL-запросы
+# замеряются событиями движка (instrument_database), остальное — счетчики из stats() модулей
+metrics.register_collector("result_cache", result_cache.stats)
+metrics.register_collector("recommendation_cache", recommendation_cache.stats)
+metrics.register_collector("recommendation_executor", recommendation_executor.stats)
+metrics.register_collector(
+    "recommendation", lambda: {"coalesced_requests": recommendations.coalesced_requests}
+)
+metrics.register_collector("dropped_updates", drop_stats)
+
+
+async def post_init(application: Application):
+    startup_timer.mark("initialize")
+    logger.info("Бот готов к работе за %s", startup_timer.summary())
+    # соединение с базой и мапперы готовятся в фоне, а не на первом квизе;
+    # со снимком подбор идет в памяти, и прогрев только импортировал бы SQLAlchemy
+    if not catalog_from_snapshot:
+        application.create_task(recommendation_executor.run(warm_up_database))
+    if profiler.install_signal_handler(asyncio.get_running_loop()):
+        logger.info("Профилирование: kill -USR1 %d", os.getpid())
+
+
+async def post_shutdown(application: Application):
+    from database import pool_stats
+
+    profiler.stop()
+    recommendation_executor.shutdown()
+    logger.info("Кэш подборок: %s", result_cache.stats())
+    logger.info("Пул соединений с базой: %s", pool_stats())
+    processor = application.update_processor
+    if isinstance(processor, ChatOrderedUpdateProcessor):
+        logger.info("Обработка апдейтов: %s", processor.stats())
+
+
+def instrument_database():
+    """Метрики SQL и пула соединений; database импортируется, только если метрики включены."""
+    if not metrics.ENABLED:
+        return
+    from database import engine, pool_stats
+
+    metrics.instrument_engine(engine)
+    metrics.register_collector("db_pool", pool_stats)
+
+
+def setup_recommender(catalog=None):
+    """catalog — готовый снимок каталога для движка в памяти; без него каталог читается из базы."""
+    if RECOMMENDER_ENGINE == "memory":
+        from catalog_engine import MemoryCatalogEngine
+
+        engine = MemoryCatalogEngine(catalog=catalog)
+        set_recommender(engine.recommend, blocking=False)
+        catalog_watcher.subscribe(lambda categories: engine.reload())
+        logger.info("Каталог загружен в память: %d продуктов", len(engine.catalog))
+        return engine
+    return None
+
+
+def build_application(builder=None, persistence=None):
+    """Собирает Application со всеми обработчиками; builder можно передать для тестов."""
+    if builder is None:
+        builder = Application.builder().token(BOT_TOKEN)
+        if metrics.ENABLED:
+            from telegram.request import HTTPXRequest
+
+            # тот же HTTPXRequest, что python-telegram-bot создает по умолчанию, но с замером вызовов
+            builder = builder.request(metrics.InstrumentedRequest(HTTPXRequest(connection_pool_size=256)))
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    if UPDATE_CONCURRENCY > 1:
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+    application = builder.post_init(post_init).post_shutdown(post_shutdown).build()
+    instrument_database()
+    if isinstance(application.update_processor, ChatOrderedUpdateProcessor):
+        metrics.register_collector("updates", application.update_processor.stats)
+    instrument = metrics.instrument_handler
+
+    # дешевые фильтры до основных обработчиков: лимит частоты и повторные нажатия,
+    # затем устаревшие кнопки и лишние апдейты
+    application.add_handler(TypeHandler(Update, limit_updates), group=-2)
+    application.add_handler(TypeHandler(Update, drop_stale_updates), group=-1)
+    application.add_handler(CommandHandler("start", instrument(start)))
+    if ADMIN_IDS:
+        application.add_handler(
+            CommandHandler("profile", profile_command, filters=filters.User(user_id=ADMIN_IDS))
+        )
+
+    if QUIZ_MODE == "stateless":
+        application.add_handler(CommandHandler("quiz", instrument(stateless_quiz_start)))
+        application.add_handler(
+            CallbackQueryHandler(instrument(handle_stateless_answer), pattern=STATELESS_PATTERN)
+        )
+        application.add_handler(CommandHandler("cancel", instrument(cancel)))
+        return application
 
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('quiz', quiz_start)],
+        entry_points=[CommandHandler('quiz', instrument(quiz_start))],
         states={
-            EYE_COLOR: [CallbackQueryHandler(handle_eye_color, pattern="^eye_")],
-            SKIN_TONE: [CallbackQueryHandler(handle_skin_tone, pattern="^skin_")],
-            HAIR_COLOR: [CallbackQueryHandler(handle_hair_color, pattern="^hair_")],
-            FACE_SHAPE: [CallbackQueryHandler(handle_face_shape, pattern="^face_")],
-            OCCASION: [CallbackQueryHandler(handle_occasion, pattern="^occasion_")],
+            # у каждого шага своя метрика: handle_eye_color, handle_skin_tone, ...
+            step: [CallbackQueryHandler(
+                instrument(handle_answer, f"handle_{question.field}"), pattern=f"^{question.prefix}_"
+            )]
+            for step, question in enumerate(QUESTIONS)
         },
-        fallbacks=[CommandHandler('cancel', cancel)],
+        fallbacks=[CommandHandler('cancel', instrument(cancel))],
+        name="quiz",
+        persistent=persistence is not None,
     )
 
-    application.add_handler(CommandHandler("start", start))
     application.add_handler(conv_handler)
+    return application
+
+
+def main():
+    global catalog_from_snapshot
+
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise SystemExit("BOT_MODE=webhook: задайте WEBHOOK_URL — публичный HTTPS-адрес бота")
+
+    snapshot = None
+    if RECOMMENDER_ENGINE == "memory":
+        from catalog_engine import CATALOG_SNAPSHOT, read_snapshot
+
+        snapshot = read_snapshot(CATALOG_SNAPSHOT)
+
+    catalog = None
+    if snapshot is not None:
+        # Таблицы создал load_data.py, когда писал снимок, поэтому init_db не нужен,
+        # а к базе бот обратится только при проверке версий через CATALOG_CHECK_INTERVAL
+        catalog, versions = snapshot
+        catalog_watcher.prime(versions)
+        catalog_from_snapshot = True
+        logger.info("Каталог из снимка %s", CATALOG_SNAPSHOT)
+    else:
+        from database import DB_READ_ONLY, init_db
+
+        if not DB_READ_ONLY:
+            init_db()
+        # запоминаем текущие версии каталога до загрузки движка в память
+        catalog_watcher.check()
+    startup_timer.mark("база и каталог")
+
+    setup_recommender(catalog)
+    application = build_application(persistence=build_persistence())
+    metrics.start()
+    startup_timer.mark("Application")
+    allowed_updates = allowed_updates_for(application)
+
+    logger.info("Запрашиваемые типы апдейтов: %s", ", ".join(allowed_updates))
+    logger.info(
+        "Подбор косметики: %d потоков, до %d одновременных запросов",
+        recommendation_executor.workers,
+        recommendation_executor.max_inflight,
+    )
+
+    if BOT_MODE == "webhook":
+        logger.info(
+            "Бот запущен в режиме webhook на %s:%d/%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH
+        )
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=allowed_updates,
+        )
+        return
 
     logger.info("Бот запущен...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    application.run_polling(allowed_updates=allowed_updates)
 
 
 if __name__ == '__main__':
     main()
-
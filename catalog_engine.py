@@ -0,0 +1,192 @@
+import marshal
+import os
+import threading
+from pathlib import Path
+
+import metrics
+from catalog_types import PRODUCT_TYPES
+from recommendations import ANSWER_FIELDS, MAX_PRODUCTS_PER_TYPE, ProductCard
+
+# Колонки Product, которые попадают в ответ бота; JSON-списки признаков не читаются
+CARD_FIELDS = ProductCard._fields
+
+# Снимок каталога, который пишет load_data.py: бот с движком в памяти стартует
+# с него, не читая базу
+CATALOG_SNAPSHOT = Path(os.getenv("CATALOG_SNAPSHOT", str(Path(__file__).parent / "catalog.snapshot")))
+SNAPSHOT_MAGIC = b"BMCATALOG"
+# Увеличивается при любом изменении формата; снимок другой версии игнорируется
+SNAPSHOT_FORMAT = 2
+
+
+class BitsetCatalog:
+    """Неизменяемый снимок каталога в памяти.
+
+    Продукты каждой категории лежат в списке в порядке id, а для каждого
+    значения признака хранится битовая маска (int) продуктов, у которых оно есть.
+    Подбор — это несколько AND по маскам на категорию.
+    """
+
+    def __init__(self):
+        self.cards = {}
+        self.bitsets = {}
+
+    def _add_card(self, category, card):
+        cards = self.cards.setdefault(category, [])
+        self.bitsets.setdefault(category, {})
+        cards.append(card)
+        return 1 << (len(cards) - 1)
+
+    @classmethod
+    def from_rows(cls, product_rows, attribute_rows):
+        """Снимок из кортежей без ORM: (category, *поля ProductCard) в порядке id
+        и (product_id, attr, value) из product_attributes."""
+        catalog = cls()
+        bits = {}
+        for category, *fields in product_rows:
+            card = ProductCard(*fields)
+            bit = catalog._add_card(category, card)
+            bits[card.id] = (catalog.bitsets[category], bit)
+
+        answer_fields = set(ANSWER_FIELDS)
+        for product_id, attr, value in attribute_rows:
+            if attr not in answer_fields or product_id not in bits:
+                continue
+            bitsets, bit = bits[product_id]
+            bitsets[(attr, value)] = bitsets.get((attr, value), 0) | bit
+        return catalog
+
+    def __len__(self):
+        return sum(len(cards) for cards in self.cards.values())
+
+    def to_snapshot(self):
+        """Только встроенные типы: карточки — кортежи, маски — int."""
+        return {
+            category: ([tuple(card) for card in cards], self.bitsets[category])
+            for category, cards in self.cards.items()
+        }
+
+    @classmethod
+    def from_snapshot(cls, data):
+        catalog = cls()
+        for category, (cards, bitsets) in data.items():
+            catalog.cards[category] = [ProductCard._make(card) for card in cards]
+            catalog.bitsets[category] = bitsets
+        return catalog
+
+    def recommend(self, skin_tone, eye_color, hair_color, face_shape, occasion, depths=None):
+        """depths, если передан, заполняется уровнем каскада по категориям (1..5)."""
+        answers = (skin_tone, eye_color, hair_color, face_shape, occasion)
+        recommendations = {}
+
+        for product_type in PRODUCT_TYPES:
+            bitsets = self.bitsets.get(product_type)
+            if not bitsets:
+                continue
+
+            # Маски уровней каскада: тон кожи, затем + глаза, + волосы, + лицо, + повод
+            mask = -1
+            best = 0
+            level = 0
+            for field, value in zip(ANSWER_FIELDS, answers):
+                mask &= bitsets.get((field, value), 0)
+                if not mask:
+                    break
+                best = mask
+                level += 1
+
+            if best:
+                if depths is not None:
+                    depths[product_type] = level
+                cards = self.cards[product_type]
+                picked = []
+                while best and len(picked) < MAX_PRODUCTS_PER_TYPE:
+                    lowest = best & -best
+                    picked.append(cards[lowest.bit_length() - 1])
+                    best ^= lowest
+                recommendations[product_type] = picked
+
+        return recommendations
+
+
+def load_catalog(conn=None):
+    """Снимок каталога из базы: только колонки карточки и строки product_attributes."""
+    from sqlalchemy import select
+    from database import engine, Product, ProductAttribute
+
+    if conn is None:
+        with engine.connect() as conn:
+            return load_catalog(conn)
+
+    card_columns = [getattr(Product, field) for field in CARD_FIELDS]
+    products = conn.execute(select(Product.category, *card_columns).order_by(Product.id))
+    attributes = conn.execute(
+        select(ProductAttribute.product_id, ProductAttribute.attr, ProductAttribute.value)
+    )
+    return BitsetCatalog.from_rows(products, attributes)
+
+
+def write_snapshot(path=CATALOG_SNAPSHOT):
+    """Пишет снимок каталога и версии категорий, прочитанные в одной транзакции."""
+    from database import engine, get_catalog_versions
+
+    with engine.connect() as conn:
+        catalog = load_catalog(conn)
+        versions = get_catalog_versions(conn)
+
+    path = Path(path)
+    temporary = path.with_name(path.name + ".tmp")
+    with open(temporary, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        marshal.dump((SNAPSHOT_FORMAT, versions, catalog.to_snapshot()), f)
+    # бот, который стартует в этот момент, видит либо старый снимок, либо новый
+    os.replace(temporary, path)
+    return len(catalog)
+
+
+def read_snapshot(path=CATALOG_SNAPSHOT):
+    """(каталог, версии категорий) или None, если снимка нет или он другого формата.
+
+    Снимок — marshal из встроенных типов (кортежи, словари, str, int, float):
+    в отличие от pickle, чтение не выполняет код. Формат marshal зависит от
+    версии Python; снимок, который не читается, считается отсутствующим.
+    """
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                return None
+            snapshot_format, versions, data = marshal.load(f)
+    except (FileNotFoundError, EOFError, ValueError, TypeError):
+        return None
+    if snapshot_format != SNAPSHOT_FORMAT:
+        return None
+    return BitsetCatalog.from_snapshot(data), versions
+
+
+class MemoryCatalogEngine:
+    """Движок подбора поверх BitsetCatalog с атомарной перезагрузкой.
+
+    Новый снимок строится целиком и подменяется одной ссылкой, поэтому
+    запросы во время reload() видят либо старый, либо новый каталог.
+    """
+
+    def __init__(self, loader=load_catalog, catalog=None):
+        """catalog — готовый снимок (например, из read_snapshot); иначе он загружается loader()."""
+        self._loader = loader
+        self._reload_lock = threading.Lock()
+        self.catalog = catalog if catalog is not None else loader()
+
+    def reload(self):
+        with self._reload_lock:
+            catalog = self._loader()
+            self.catalog = catalog
+        return catalog
+
+    def recommend(self, skin_tone, eye_color, hair_color, face_shape, occasion):
+        if not metrics.ENABLED:
+            return self.catalog.recommend(skin_tone, eye_color, hair_color, face_shape, occasion)
+        depths = {}
+        recommendations = self.catalog.recommend(
+            skin_tone, eye_color, hair_color, face_shape, occasion, depths=depths
+        )
+        metrics.observe_depths(depths)
+        return recommendations
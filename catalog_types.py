@@ -0,0 +1,5 @@
+# Категории каталога в порядке блоков подборки. Модуль без зависимостей:
+# его импортируют и database.py, и движок в памяти, которому SQLAlchemy не нужна
+PRODUCT_TYPES = (
+    "highlighter", "lipstick", "lip_gloss", "foundation", "eyeshadow", "mascara", "blush", "eyeliner",
+)
@@ -1,73 +1,195 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Text, JSON
+from sqlalchemy import create_engine, event, exc, Boolean, Column, Integer, String, Float, Text, JSON
+from sqlalchemy import ForeignKey, Index, MetaData, Table, insert, inspect, select
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 import os
+import threading
+import time
 from pathlib import Path
 
+from catalog_types import PRODUCT_TYPES
+
 # SQLite база данных будет создана в корне проекта
 DB_PATH = Path(__file__).parent / "makeup_bot.db"
 DATABASE_URL = os.getenv("DATABASE_URL", f"sqlite:///{DB_PATH}")
 
-engine = create_engine(DATABASE_URL, echo=False)
+# Пул соединений: на пике бот держит до RECOMMENDER_WORKERS соединений,
+# load_data.py — по одному на поток записи
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Только для серверных СУБД (PostgreSQL): проверка соединения перед выдачей
+# и пересоздание старых соединений, которые мог закрыть сервер или балансировщик
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+# Настройки SQLite, которые применяются к каждому новому соединению
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Отрицательное значение — размер в КиБ (по умолчанию 64 МиБ)
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-65536"))
+
+# DB_READ_ONLY=1 — процесс бота только читает каталог: SQLite открывается с mode=ro,
+# в PostgreSQL транзакции по умолчанию read only. Таблицы создает load_data.py.
+DB_READ_ONLY = os.getenv("DB_READ_ONLY", "0") == "1"
+
+
+class PoolMetrics:
+    """Счетчики пула: сколько ждали свободного соединения и сколько их занято."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.waited = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.peak_checked_out = 0
+
+    def record_wait(self, seconds: float):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            # меньше миллисекунды — соединение было свободно сразу
+            if seconds >= 0.001:
+                self.waited += 1
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def record_checked_out(self, count: int):
+        with self._lock:
+            self.peak_checked_out = max(self.peak_checked_out, count)
+
+
+pool_metrics = PoolMetrics()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool, который замеряет ожидание свободного соединения."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.record_timeout()
+            raise
+        pool_metrics.record_wait(time.perf_counter() - started)
+        pool_metrics.record_checked_out(self.checkedout())
+        return connection
+
+
+def _engine_options(url):
+    options = {
+        "echo": False,
+        "poolclass": TimedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+    }
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            # база в памяти живет в одном соединении, пул по умолчанию
+            return {"echo": False}
+        return options
+
+    options["pool_pre_ping"] = DB_POOL_PRE_PING
+    options["pool_recycle"] = DB_POOL_RECYCLE
+    if DB_READ_ONLY and url.get_backend_name() == "postgresql":
+        options["connect_args"] = {"options": "-c default_transaction_read_only=on"}
+    return options
+
+
+def _read_only_url(url):
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        return url
+    return url.set(database=f"file:{url.database}?mode=ro", query={**url.query, "uri": "true"})
+
+
+def _configure_sqlite(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    if not DB_READ_ONLY:
+        # WAL сохраняется в файле базы: читатели не ждут писателя (load_data.py)
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    cursor.close()
+
+
+def _create_engine():
+    url = make_url(DATABASE_URL)
+    options = _engine_options(url)
+    if DB_READ_ONLY:
+        url = _read_only_url(url)
+    created = create_engine(url, **options)
+    if created.dialect.name == "sqlite" and options.get("poolclass") is TimedQueuePool:
+        event.listen(created, "connect", _configure_sqlite)
+    return created
+
+
+engine = _create_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def pool_stats():
+    """Состояние пула соединений и время ожидания свободного соединения."""
+    pool = engine.pool
+    if not isinstance(pool, TimedQueuePool):
+        return {"pool": type(pool).__name__}
+    capacity = pool.size() + max(DB_MAX_OVERFLOW, 0)
+    checked_out = pool.checkedout()
+    metrics = pool_metrics
+    return {
+        "pool": type(pool).__name__,
+        "size": pool.size(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checked_out": checked_out,
+        "overflow": max(pool.overflow(), 0),
+        "utilization": round(checked_out / capacity, 4) if capacity else 0.0,
+        "peak_checked_out": metrics.peak_checked_out,
+        "checkouts": metrics.checkouts,
+        "waited": metrics.waited,
+        "timeouts": metrics.timeouts,
+        "wait_avg_ms": round(metrics.wait_total / metrics.checkouts * 1000, 3) if metrics.checkouts else 0.0,
+        "wait_max_ms": round(metrics.wait_max * 1000, 3),
+    }
+
+
 Base = declarative_base()
 
 
-class Highlighter(Base):
-    __tablename__ = "highlighters"
-    
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, nullable=False)
-    brand = Column(String, nullable=False)
-    color = Column(String, nullable=False)
-    skin_tone = Column(JSON, nullable=False)
-    eye_color = Column(JSON, nullable=False)
-    hair_color = Column(JSON, nullable=True)
-    face_shape = Column(JSON, nullable=True)
-    occasion = Column(JSON, nullable=False)
-    price = Column(Float, nullable=False)
-    description = Column(Text)
-    image_url = Column(String)
+# Признаки продукта, по которым идет подбор
+ATTRIBUTE_FIELDS = ("skin_tone", "eye_color", "hair_color", "face_shape", "occasion")
 
 
-class Lipstick(Base):
-    __tablename__ = "lipsticks"
-    
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, nullable=False)
-    brand = Column(String, nullable=False)
-    color = Column(String, nullable=False)
-    skin_tone = Column(JSON, nullable=False)
-    eye_color = Column(JSON, nullable=False)
-    hair_color = Column(JSON, nullable=True)
-    face_shape = Column(JSON, nullable=True)
-    occasion = Column(JSON, nullable=False)
-    price = Column(Float, nullable=False)
-    description = Column(Text)
-    image_url = Column(String)
+# Нормализованный индекс признаков: одна строка на каждое значение из JSON-списков
+# продукта. Поиск по (attr, value) идет по B-tree индексу и в SQLite, и в PostgreSQL.
+class ProductAttribute(Base):
+    __tablename__ = "product_attributes"
+    __table_args__ = (
+        Index("ix_product_attributes_lookup", "attr", "value", "product_id"),
+    )
 
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True)
+    attr = Column(String, primary_key=True)
+    value = Column(String, primary_key=True)
 
-class LipGloss(Base):
-    __tablename__ = "lip_glosses"
-    
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, nullable=False)
-    brand = Column(String, nullable=False)
-    color = Column(String, nullable=False)
-    skin_tone = Column(JSON, nullable=False)
-    eye_color = Column(JSON, nullable=False)
-    hair_color = Column(JSON, nullable=True)
-    face_shape = Column(JSON, nullable=True)
-    occasion = Column(JSON, nullable=False)
-    price = Column(Float, nullable=False)
-    description = Column(Text)
-    image_url = Column(String)
 
+# Все категории косметики хранятся в одной таблице, категория — в колонке category
+class Product(Base):
+    __tablename__ = "products"
+    __table_args__ = (
+        Index("ix_products_category_id", "category", "id"),
+        Index("uq_products_category_name_brand", "category", "name", "brand", unique=True),
+    )
 
-class Foundation(Base):
-    __tablename__ = "foundations"
-    
     id = Column(Integer, primary_key=True, index=True)
+    category = Column(String, nullable=False)
     name = Column(String, nullable=False)
     brand = Column(String, nullable=False)
     color = Column(String, nullable=False)
@@ -79,78 +201,232 @@ class Foundation(Base):
     price = Column(Float, nullable=False)
     description = Column(Text)
     image_url = Column(String)
+    # sha256 от содержимого записи фида, см. load_data.content_hash
+    content_hash = Column(String)
+    # Файл фида, из которого продукт загружен последним (catalog_sources.source):
+    # --delete-missing удаляет только продукты того же файла
+    source = Column(String)
 
+    __mapper_args__ = {"polymorphic_on": category}
 
-class Eyeshadow(Base):
-    __tablename__ = "eyeshadows"
-    
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, nullable=False)
-    brand = Column(String, nullable=False)
-    color = Column(String, nullable=False)
-    skin_tone = Column(JSON, nullable=False)
-    eye_color = Column(JSON, nullable=False)
-    hair_color = Column(JSON, nullable=True)
-    face_shape = Column(JSON, nullable=True)
-    occasion = Column(JSON, nullable=False)
-    price = Column(Float, nullable=False)
-    description = Column(Text)
-    image_url = Column(String)
 
+# Старые классы оставлены для совместимости: это та же таблица products,
+# отфильтрованная по категории
+class Highlighter(Product):
+    __mapper_args__ = {"polymorphic_identity": "highlighter"}
 
-class Mascara(Base):
-    __tablename__ = "mascaras"
-    
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, nullable=False)
-    brand = Column(String, nullable=False)
-    color = Column(String, nullable=False)
-    skin_tone = Column(JSON, nullable=False)
-    eye_color = Column(JSON, nullable=False)
-    hair_color = Column(JSON, nullable=True)
-    face_shape = Column(JSON, nullable=True)
-    occasion = Column(JSON, nullable=False)
-    price = Column(Float, nullable=False)
-    description = Column(Text)
-    image_url = Column(String)
 
+class Lipstick(Product):
+    __mapper_args__ = {"polymorphic_identity": "lipstick"}
 
-class Blush(Base):
-    __tablename__ = "blushes"
 
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, nullable=False)
-    brand = Column(String, nullable=False)
-    color = Column(String, nullable=False)
-    skin_tone = Column(JSON, nullable=False)
-    eye_color = Column(JSON, nullable=False)
-    hair_color = Column(JSON, nullable=True)
-    face_shape = Column(JSON, nullable=True)
-    occasion = Column(JSON, nullable=False)
-    price = Column(Float, nullable=False)
-    description = Column(Text)
-    image_url = Column(String)
+class LipGloss(Product):
+    __mapper_args__ = {"polymorphic_identity": "lip_gloss"}
 
 
-class Eyeliner(Base):
-    __tablename__ = "eyeliners"
+class Foundation(Product):
+    __mapper_args__ = {"polymorphic_identity": "foundation"}
+
+
+class Eyeshadow(Product):
+    __mapper_args__ = {"polymorphic_identity": "eyeshadow"}
+
+
+class Mascara(Product):
+    __mapper_args__ = {"polymorphic_identity": "mascara"}
+
+
+class Blush(Product):
+    __mapper_args__ = {"polymorphic_identity": "blush"}
+
+
+class Eyeliner(Product):
+    __mapper_args__ = {"polymorphic_identity": "eyeliner"}
 
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, nullable=False)
-    brand = Column(String, nullable=False)
-    color = Column(String, nullable=False)
-    skin_tone = Column(JSON, nullable=False)
-    eye_color = Column(JSON, nullable=False)
-    hair_color = Column(JSON, nullable=True)
-    face_shape = Column(JSON, nullable=True)
-    occasion = Column(JSON, nullable=False)
-    price = Column(Float, nullable=False)
-    description = Column(Text)
-    image_url = Column(String)
+
+# Порядок и состав категорий — из catalog_types.PRODUCT_TYPES; категория
+# без класса выше даст KeyError при импорте
+PRODUCT_MODELS = {
+    product_type: Product.__mapper__.polymorphic_map[product_type].class_
+    for product_type in PRODUCT_TYPES
+}
+
+
+# Готовые подборки для всех комбинаций ответов квиза (строится в load_data.py)
+class PrecomputedRecommendation(Base):
+    __tablename__ = "precomputed_recommendations"
+
+    answer_key = Column(String, primary_key=True)
+    payload = Column(JSON, nullable=False)
+
+
+# Сколько записей фида уже закоммичено — чтобы продолжить прерванную загрузку
+class IngestCheckpoint(Base):
+    __tablename__ = "ingest_checkpoints"
+
+    source = Column(String, primary_key=True)
+    product_type = Column(String, nullable=False)
+    file_size = Column(Integer, nullable=False)
+    file_mtime = Column(Float, nullable=False)
+    records_committed = Column(Integer, nullable=False, default=0)
+
+
+# Хэш последнего загруженного содержимого каждого файла каталога
+class CatalogSource(Base):
+    __tablename__ = "catalog_sources"
+
+    source = Column(String, primary_key=True)
+    product_type = Column(String, nullable=False)
+    file_hash = Column(String, nullable=False)
+    # Версия категории сразу после загрузки файла (см. pending_catalog_version):
+    # если категорию с тех пор меняли другим файлом, этот файл загружается снова
+    category_version = Column(Integer)
+
+
+# Версия каталога по категориям: load_data.py увеличивает ее при любом изменении
+class CatalogVersion(Base):
+    __tablename__ = "catalog_versions"
+
+    category = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    # Изменения категории закоммичены, но таблица подборок еще не пересчитана.
+    # Ставится в транзакции пакета, поэтому переживает прерванную загрузку.
+    dirty = Column(Boolean)
+
+
+def mark_catalog_dirty(db, category):
+    row = db.get(CatalogVersion, category)
+    if row is None:
+        db.add(CatalogVersion(category=category, version=0, dirty=True))
+    elif not row.dirty:
+        row.dirty = True
+
+
+def pending_catalog_version(db, category):
+    """Версия, которую категория получит при ближайшей публикации."""
+    row = db.get(CatalogVersion, category)
+    if row is None:
+        return 0
+    return row.version + 1 if row.dirty else row.version
+
+
+def dirty_categories(db):
+    return list(db.execute(
+        select(CatalogVersion.category).where(CatalogVersion.dirty.is_(True)).order_by(CatalogVersion.category)
+    ).scalars())
+
+
+def bump_catalog_versions(db, categories):
+    for category in categories:
+        row = db.get(CatalogVersion, category)
+        if row is None:
+            db.add(CatalogVersion(category=category, version=1))
+        else:
+            row.version += 1
+            row.dirty = False
+
+
+def get_catalog_versions(db):
+    # версия 0 — категория еще ни разу не публиковалась (см. dirty)
+    return dict(db.execute(
+        select(CatalogVersion.category, CatalogVersion.version).where(CatalogVersion.version > 0)
+    ).all())
+
+
+# Таблицы, в которых категории хранились до перехода на products
+LEGACY_TABLES = {
+    "highlighter": "highlighters",
+    "lipstick": "lipsticks",
+    "lip_gloss": "lip_glosses",
+    "foundation": "foundations",
+    "eyeshadow": "eyeshadows",
+    "mascara": "mascaras",
+    "blush": "blushes",
+    "eyeliner": "eyeliners",
+}
+
+
+def migrate_legacy_tables():
+    """Переносит продукты из старых таблиц по категориям в products и удаляет их."""
+    existing_tables = set(inspect(engine).get_table_names())
+    product_columns = [c.name for c in Product.__table__.columns if c.name not in ("id", "category")]
+    migrated = 0
+
+    with engine.begin() as conn:
+        for category, table_name in LEGACY_TABLES.items():
+            if table_name not in existing_tables:
+                continue
+
+            legacy_table = Table(table_name, MetaData(), autoload_with=conn)
+            # в старых таблицах нет новых колонок (content_hash, source) — они остаются NULL
+            copied_columns = [c for c in product_columns if c in legacy_table.c]
+            known = set(conn.execute(
+                select(Product.name, Product.brand).where(Product.category == category)
+            ).all())
+
+            rows = []
+            for row in conn.execute(select(legacy_table).order_by(legacy_table.c.id)).mappings():
+                if (row["name"], row["brand"]) in known:
+                    continue
+                rows.append({"category": category, **{c: row[c] for c in copied_columns}})
+
+            if rows:
+                conn.execute(insert(Product.__table__), rows)
+                migrated += len(rows)
+            legacy_table.drop(conn)
+
+    return migrated
+
+
+def attribute_rows(product_id, values, fields=ATTRIBUTE_FIELDS):
+    return [
+        {"product_id": product_id, "attr": field, "value": value}
+        for field in fields
+        for value in dict.fromkeys(values.get(field) or ())
+    ]
+
+
+def rebuild_product_attributes():
+    """Заполняет product_attributes заново по JSON-колонкам всех продуктов."""
+    with engine.begin() as conn:
+        conn.execute(ProductAttribute.__table__.delete())
+        rows = []
+        for product in conn.execute(select(Product.__table__)):
+            rows.extend(attribute_rows(product.id, product._mapping))
+        if rows:
+            conn.execute(insert(ProductAttribute.__table__), rows)
+    return len(rows)
+
+
+def add_missing_columns():
+    """create_all не меняет существующие таблицы: добавляем новые nullable-колонки."""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns and column.nullable:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
 
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+    # create_all не добавляет индексы в уже существующие таблицы
+    for index in Product.__table__.indexes:
+        index.create(engine, checkfirst=True)
+    migrated = migrate_legacy_tables()
+
+    with engine.connect() as conn:
+        has_products = conn.execute(select(Product.id).limit(1)).first() is not None
+        has_attributes = conn.execute(select(ProductAttribute.product_id).limit(1)).first() is not None
+    if migrated or (has_products and not has_attributes):
+        rebuild_product_attributes()
 
 
 def get_db():
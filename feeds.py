@@ -0,0 +1,144 @@
+import hashlib
+import json
+import time
+from collections import namedtuple
+
+from database import ATTRIBUTE_FIELDS
+
+CHUNK_SIZE = 1 << 16
+# Самая длинная запись JSON-массива, символов: дальше ошибка разбора считается
+# повреждением файла, а не записью, оборванной на границе блока
+MAX_RECORD_SIZE = 1 << 20
+
+REQUIRED_FIELDS = ("name", "brand", "color", "skin_tone", "eye_color", "occasion", "price")
+OPTIONAL_LIST_FIELDS = ("hair_color", "face_shape")
+
+
+ParsedFeed = namedtuple("ParsedFeed", ["products", "invalid", "errors", "elapsed"])
+
+
+class FeedError(ValueError):
+    pass
+
+
+def file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def validate_product(product_data):
+    """Проверяет одну запись фида; возвращает ее же или бросает FeedError."""
+    if not isinstance(product_data, dict):
+        raise FeedError(f"ожидался объект, получено {type(product_data).__name__}")
+
+    missing = [field for field in REQUIRED_FIELDS if product_data.get(field) in (None, "")]
+    if missing:
+        raise FeedError(f"нет обязательных полей: {', '.join(missing)}")
+
+    for field in ATTRIBUTE_FIELDS:
+        values = product_data.get(field)
+        if values is None and field in OPTIONAL_LIST_FIELDS:
+            continue
+        if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+            raise FeedError(f"поле {field} должно быть списком строк")
+
+    price = product_data["price"]
+    if isinstance(price, bool) or not isinstance(price, (int, float)):
+        raise FeedError("поле price должно быть числом")
+
+    return product_data
+
+
+def _iter_json_array(f):
+    """Потоково разбирает JSON-массив объектов, не читая файл целиком."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    eof = False
+    started = False
+
+    while True:
+        position = 0
+        while True:
+            # пропускаем пробелы, запятые и открывающую скобку массива
+            while position < len(buffer) and buffer[position] in " \t\r\n,[":
+                if buffer[position] == "[":
+                    if started:
+                        break
+                    started = True
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            if position >= len(buffer):
+                break
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise FeedError("JSON-массив оборван или поврежден") from e
+                if len(buffer) - position > MAX_RECORD_SIZE:
+                    # без предела поврежденная запись в начале файла заставила бы
+                    # дочитать в память весь остаток массива
+                    raise FeedError(
+                        f"JSON-массив поврежден или запись длиннее {MAX_RECORD_SIZE} символов: {e.msg}"
+                    ) from e
+                break
+            if end == len(buffer) and not eof:
+                # значение могло оборваться на границе блока
+                break
+            yield item
+            position = end
+
+        buffer = buffer[position:]
+        if eof:
+            if buffer.strip():
+                raise FeedError("JSON-массив оборван или поврежден")
+            return
+        chunk = f.read(CHUNK_SIZE)
+        eof = not chunk
+        buffer += chunk
+
+
+def _iter_ndjson(f):
+    for line_number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            raise FeedError(f"строка {line_number}: {e}") from e
+
+
+def iter_products(file_path):
+    """Продукты из файла по одному: JSON-массив или NDJSON (объект на строку)."""
+    with open(file_path, "r", encoding="utf-8") as f:
+        first = f.read(1)
+        while first and first.isspace():
+            first = f.read(1)
+        f.seek(0)
+
+        if first == "[":
+            yield from _iter_json_array(f)
+        else:
+            yield from _iter_ndjson(f)
+
+
+def parse_feed(file_path, max_errors: int = 20):
+    """Читает и проверяет фид целиком; вызывается в отдельном процессе."""
+    started = time.perf_counter()
+    products = []
+    invalid = 0
+    errors = []
+
+    for number, product_data in enumerate(iter_products(file_path), 1):
+        try:
+            products.append(validate_product(product_data))
+        except FeedError as e:
+            invalid += 1
+            if len(errors) < max_errors:
+                errors.append(f"запись {number} пропущена: {e}")
+
+    return ParsedFeed(products, invalid, errors, time.perf_counter() - started)
@@ -1,299 +1,235 @@
+import os
+from collections import namedtuple
+from functools import lru_cache
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
 
-from database import SessionLocal
-from database import (
-    Highlighter,
-    Lipstick,
-    LipGloss,
-    Foundation,
-    Eyeshadow,
-    Mascara,
-    Blush,
-    Eyeliner,
+from cache import TTLCache
+from recommendations import (
+    catalog_watcher,
+    check_catalog,
+    get_products_by_preferences_async,
+    EYE_COLORS,
+    SKIN_TONES,
+    HAIR_COLORS,
+    FACE_SHAPES,
+    OCCASIONS,
 )
 
 
-EYE_COLOR, SKIN_TONE, HAIR_COLOR, FACE_SHAPE, OCCASION = range(5)
-
-EYE_COLORS = ["карие", "зеленые", "голубые", "серые", "темные"]
-SKIN_TONES = ["светлый", "средний", "темный"]
-HAIR_COLORS = ["блондин", "русые", "шатен", "брюнет", "рыжие"]
-FACE_SHAPES = ["овальное", "квадратное", "круглое", "треугольное"]
-OCCASIONS = [
-    "повседневный",
-    "офисный",
-    "вечерний",
-    "особый",
-    "летний",
-    "натуральный",
-    "осенний",
-    "зимний",
-]
-
-
-def get_products_by_preferences(
-    skin_tone: str,
-    eye_color: str,
-    hair_color: str,
-    face_shape: str,
-    occasion: str,
-):
-    db = SessionLocal()
-    recommendations = {}
-
-    try:
-        product_types = {
-            "highlighter": Highlighter,
-            "lipstick": Lipstick,
-            "lip_gloss": LipGloss,
-            "foundation": Foundation,
-            "eyeshadow": Eyeshadow,
-            "mascara": Mascara,
-            "blush": Blush,
-            "eyeliner": Eyeliner,
-        }
-
-        for product_type, model_class in product_types.items():
-            products = db.query(model_class).filter(
-                model_class.skin_tone.op("@>")([skin_tone]),
-                model_class.eye_color.op("@>")([eye_color]),
-                model_class.hair_color.op("@>")([hair_color]),
-                model_class.face_shape.op("@>")([face_shape]),
-                model_class.occasion.op("@>")([occasion]),
-            ).all()
-
-            if not products:
-                products = db.query(model_class).filter(
-                    model_class.skin_tone.op("@>")([skin_tone]),
-                    model_class.eye_color.op("@>")([eye_color]),
-                    model_class.hair_color.op("@>")([hair_color]),
-                    model_class.face_shape.op("@>")([face_shape]),
-                ).limit(2).all()
-
-            if not products:
-                products = db.query(model_class).filter(
-                    model_class.skin_tone.op("@>")([skin_tone]),
-                    model_class.eye_color.op("@>")([eye_color]),
-                    model_class.hair_color.op("@>")([hair_color]),
-                ).limit(2).all()
-
-            if not products:
-                products = db.query(model_class).filter(
-                    model_class.skin_tone.op("@>")([skin_tone]),
-                    model_class.eye_color.op("@>")([eye_color]),
-                ).limit(2).all()
-
-            if not products:
-                products = db.query(model_class).filter(
-                    model_class.skin_tone.op("@>")([skin_tone]),
-                ).limit(2).all()
-
-            if products:
-                recommendations[product_type] = products[:2]
-
-        return recommendations
-    finally:
-        db.close()
+# Вопросы квиза по порядку. Номер вопроса — он же состояние ConversationHandler;
+# prefix — начало callback_data его кнопок ("eye_карие"), field — ключ в user_data
+# и имя аргумента get_products_by_preferences_async.
+Question = namedtuple("Question", ["field", "prefix", "options", "emoji", "label", "text"])
 
+QUESTIONS = (
+    Question("eye_color", "eye", EYE_COLORS, "👁", "Цвет глаз", "Какой у тебя цвет глаз?"),
+    Question("skin_tone", "skin", SKIN_TONES, "👤", "Тон кожи", "Какой у тебя тон кожи?"),
+    Question("hair_color", "hair", HAIR_COLORS, "💇", "Цвет волос", "Какой у тебя цвет волос?"),
+    Question("face_shape", "face", FACE_SHAPES, "🙂", "Форма лица", "Какая у тебя форма лица?"),
+    Question("occasion", "occasion", OCCASIONS, "🎯", "Повод", "Для какого повода макияж?"),
+)
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    welcome_text = (
-        "Привет! Я бот для подбора косметики.\n\n"
-        "Я помогу найти продукты под твои предпочтения.\n"
-        "Нажми /quiz чтобы начать."
-    )
-    await update.message.reply_text(welcome_text)
+STEP_BY_PREFIX = {question.prefix: step for step, question in enumerate(QUESTIONS)}
 
 
-async def quiz_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data.clear()
+class StaticKeyboard(InlineKeyboardMarkup):
+    """Клавиатура, которая собирается один раз и переиспользуется во всех ответах.
 
-    keyboard = []
-    for eye_color in EYE_COLORS:
-        keyboard.append(
-            [InlineKeyboardButton(eye_color.capitalize(), callback_data=f"eye_{eye_color}")]
-        )
+    Объекты python-telegram-bot после создания неизменяемы, поэтому словарь для
+    запроса к Bot API тоже строится один раз; менять его нельзя.
+    """
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    __slots__ = ("_payload",)
 
-    await update.message.reply_text(
-        "Давай начнем.\n\n"
-        "Вопрос 1 из 5:\n"
-        "Какой у тебя цвет глаз?",
-        reply_markup=reply_markup,
-    )
+    def __init__(self, inline_keyboard):
+        super().__init__(inline_keyboard)
+        with self._unfrozen():
+            self._payload = super().to_dict()
 
-    return EYE_COLOR
+    def to_dict(self, recursive: bool = True):
+        return self._payload
 
 
-async def handle_eye_color(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+def _keyboard(options, callback_prefix: str):
+    return StaticKeyboard(
+        [[InlineKeyboardButton(option.capitalize(), callback_data=f"{callback_prefix}{option}")]
+         for option in options]
+    )
+
 
-    eye_color = query.data.split("_")[1]
-    context.user_data["eye_color"] = eye_color
+# Тексты и клавиатуры шагов собираются при импорте
+QUESTION_PROMPTS = tuple(
+    f"Вопрос {step + 1} из {len(QUESTIONS)}:\n{question.text}"
+    for step, question in enumerate(QUESTIONS)
+)
+QUESTION_KEYBOARDS = tuple(_keyboard(question.options, f"{question.prefix}_") for question in QUESTIONS)
+ANSWER_LINES = tuple(
+    {option: f"{question.label}: {option.capitalize()}" for option in question.options}
+    for question in QUESTIONS
+)
 
-    keyboard = []
-    for skin_tone in SKIN_TONES:
-        keyboard.append(
-            [InlineKeyboardButton(skin_tone.capitalize(), callback_data=f"skin_{skin_tone}")]
-        )
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
+def question_text(answers):
+    """Текст следующего вопроса после уже данных ответов (по порядку QUESTIONS)."""
+    if not answers:
+        return "Давай начнем.\n\n" + QUESTION_PROMPTS[0]
+    lines = [ANSWER_LINES[step].get(answer) or f"{QUESTIONS[step].label}: {answer.capitalize()}"
+             for step, answer in enumerate(answers)]
+    return "\n".join(lines) + "\n\n" + QUESTION_PROMPTS[len(answers)]
 
-    await query.edit_message_text(
-        f"Цвет глаз: {eye_color.capitalize()}\n\n"
-        "Вопрос 2 из 5:\n"
-        "Какой у тебя тон кожи?",
-        reply_markup=reply_markup,
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    welcome_text = (
+        "Привет! Я бот для подбора косметики.\n\n"
+        "Я помогу найти продукты под твои предпочтения.\n"
+        "Нажми /quiz чтобы начать."
     )
+    await update.message.reply_text(welcome_text)
+
 
-    return SKIN_TONE
+async def quiz_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.clear()
+    await update.message.reply_text(question_text([]), reply_markup=QUESTION_KEYBOARDS[0])
+    return 0
 
 
-async def handle_skin_tone(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+PRODUCT_TITLES = {
+    "highlighter": ("✨", "Хайлайтер"),
+    "foundation": ("🎨", "Тональный крем"),
+    "eyeshadow": ("👁️", "Тени для век"),
+    "eyeliner": ("✍️", "Подводка"),
+    "mascara": ("👀", "Тушь для ресниц"),
+    "blush": ("🩷", "Румяна"),
+    "lipstick": ("💄", "Помада"),
+    "lip_gloss": ("💋", "Блеск для губ"),
+}
 
-    skin_tone = query.data.split("_")[1]
-    context.user_data["skin_tone"] = skin_tone
 
-    keyboard = []
-    for hair_color in HAIR_COLORS:
-        keyboard.append(
-            [InlineKeyboardButton(hair_color.capitalize(), callback_data=f"hair_{hair_color}")]
-        )
+def format_result(answers, recommendations):
+    """Итоговое сообщение квиза; answers — ответы по порядку QUESTIONS."""
+    parts = ["✨ Твоя подборка:\n--------------------\n"]
+    for question, answer in zip(QUESTIONS, answers):
+        parts.append(f"{question.emoji} {question.label}: {answer.capitalize()}\n")
+    parts.append("--------------------\n\n")
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    for product_type, products in recommendations.items():
+        if products:
+            emoji, title = PRODUCT_TITLES.get(product_type, ("•", product_type))
+            parts.append(f"{emoji} {title}\n--------------------\n")
+            for product in products:
+                parts.append(f"• {product.name} — {product.brand}\n")
+                parts.append(f"  💰 {product.price:.0f} руб.\n")
+                if product.description:
+                    parts.append(f"  📝 {product.description}\n")
+                parts.append("\n")
 
-    await query.edit_message_text(
-        f"Цвет глаз: {context.user_data['eye_color'].capitalize()}\n"
-        f"Тон кожи: {skin_tone.capitalize()}\n\n"
-        "Вопрос 3 из 5:\n"
-        "Какой у тебя цвет волос?",
-        reply_markup=reply_markup,
-    )
+    if not recommendations:
+        parts.append("😕 Пока ничего не нашлось. Попробуй другие ответы.\n\n")
 
-    return HAIR_COLOR
+    parts.append("--------------------\n🔄 Хочешь еще раз? Нажми /quiz")
+    return "".join(parts)
 
 
-async def handle_hair_color(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+# Готовые тексты подборок для популярных наборов ответов. Ключ включает версию
+# каталога, а при ее смене (load_data.py) кэш очищается целиком.
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "4096"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "600"))
 
-    hair_color = query.data.split("_")[1]
-    context.user_data["hair_color"] = hair_color
+result_cache = TTLCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+catalog_watcher.subscribe(lambda categories: result_cache.clear())
 
-    keyboard = []
-    for face_shape in FACE_SHAPES:
-        keyboard.append(
-            [InlineKeyboardButton(face_shape.capitalize(), callback_data=f"face_{face_shape}")]
-        )
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
+async def recommend(answers):
+    """Подборка для полного набора ответов в виде готового текста."""
+    await check_catalog()
+    key = (tuple(answers), catalog_watcher.token)
+    result_text = result_cache.get(key)
+    if result_text is not None:
+        return result_text
 
-    await query.edit_message_text(
-        f"Цвет глаз: {context.user_data['eye_color'].capitalize()}\n"
-        f"Тон кожи: {context.user_data['skin_tone'].capitalize()}\n"
-        f"Цвет волос: {hair_color.capitalize()}\n\n"
-        "Вопрос 4 из 5:\n"
-        "Какая у тебя форма лица?",
-        reply_markup=reply_markup,
+    recommendations = await get_products_by_preferences_async(
+        **{question.field: answer for question, answer in zip(QUESTIONS, answers)}
     )
+    result_text = format_result(answers, recommendations)
+    result_cache.put(key, result_text)
+    return result_text
 
-    return FACE_SHAPE
 
-
-async def handle_face_shape(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ответ на любой вопрос квиза: шаг определяется по префиксу callback_data."""
     query = update.callback_query
     await query.answer()
 
-    face_shape = query.data.split("_")[1]
-    context.user_data["face_shape"] = face_shape
-
-    keyboard = []
-    for occasion in OCCASIONS:
-        keyboard.append(
-            [InlineKeyboardButton(occasion.capitalize(), callback_data=f"occasion_{occasion}")]
-        )
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    await query.edit_message_text(
-        f"Цвет глаз: {context.user_data['eye_color'].capitalize()}\n"
-        f"Тон кожи: {context.user_data['skin_tone'].capitalize()}\n"
-        f"Цвет волос: {context.user_data['hair_color'].capitalize()}\n"
-        f"Форма лица: {face_shape.capitalize()}\n\n"
-        "Вопрос 5 из 5:\n"
-        "Для какого повода макияж?",
-        reply_markup=reply_markup,
-    )
-
-    return OCCASION
+    prefix, answer = query.data.split("_", 1)
+    step = STEP_BY_PREFIX[prefix]
+    context.user_data[QUESTIONS[step].field] = answer
+    answers = [context.user_data[question.field] for question in QUESTIONS[:step + 1]]
 
+    if step + 1 < len(QUESTIONS):
+        await query.edit_message_text(question_text(answers), reply_markup=QUESTION_KEYBOARDS[step + 1])
+        return step + 1
 
-async def handle_occasion(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+    await query.edit_message_text(await recommend(answers))
+    return ConversationHandler.END
 
-    occasion = query.data.split("_")[1]
-    context.user_data["occasion"] = occasion
 
-    recommendations = get_products_by_preferences(
-        context.user_data["skin_tone"],
-        context.user_data["eye_color"],
-        context.user_data["hair_color"],
-        context.user_data["face_shape"],
-        occasion,
+# Квиз без состояния на сервере (QUIZ_MODE=stateless): callback_data каждой кнопки
+# содержит все ответы, данные до нее, — индексы вариантов, по цифре на вопрос,
+# например "q:2" -> "q:21" -> ... -> "q:21031". Любой воркер обработает любой шаг.
+# Поэтому в каждом вопросе не больше 10 вариантов.
+STATELESS_PREFIX = "q:"
+STATELESS_PATTERN = rf"^q:\d{{1,{len(QUESTIONS)}}}$"
+
+
+def decode_answers(data: str):
+    """Ответы из callback_data или None, если данные не от этого квиза."""
+    if not data.startswith(STATELESS_PREFIX):
+        return None
+    digits = data[len(STATELESS_PREFIX):]
+    if not digits.isdigit() or len(digits) > len(QUESTIONS):
+        return None
+
+    answers = []
+    for digit, question in zip(digits, QUESTIONS):
+        index = int(digit)
+        if index >= len(question.options):
+            return None
+        answers.append(question.options[index])
+    return digits, answers
+
+
+@lru_cache(maxsize=4096)
+def stateless_keyboard(digits: str):
+    """Клавиатура следующего вопроса; зависит только от уже данных ответов."""
+    options = QUESTIONS[len(digits)].options
+    return StaticKeyboard(
+        [[InlineKeyboardButton(option.capitalize(), callback_data=f"{STATELESS_PREFIX}{digits}{index}")]
+         for index, option in enumerate(options)]
     )
 
-    result_text = (
-        "✨ Твоя подборка:\n"
-        "--------------------\n"
-        f"👁 Цвет глаз: {context.user_data['eye_color'].capitalize()}\n"
-        f"👤 Тон кожи: {context.user_data['skin_tone'].capitalize()}\n"
-        f"💇 Цвет волос: {context.user_data['hair_color'].capitalize()}\n"
-        f"🙂 Форма лица: {context.user_data['face_shape'].capitalize()}\n"
-        f"🎯 Повод: {occasion.capitalize()}\n"
-        "--------------------\n\n"
-    )
 
-    product_titles = {
-        "highlighter": ("✨", "Хайлайтер"),
-        "foundation": ("🎨", "Тональный крем"),
-        "eyeshadow": ("👁️", "Тени для век"),
-        "eyeliner": ("✍️", "Подводка"),
-        "mascara": ("👀", "Тушь для ресниц"),
-        "blush": ("🩷", "Румяна"),
-        "lipstick": ("💄", "Помада"),
-        "lip_gloss": ("💋", "Блеск для губ"),
-    }
+async def stateless_quiz_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(question_text([]), reply_markup=stateless_keyboard(""))
 
-    for product_type, products in recommendations.items():
-        if products:
-            emoji, title = product_titles.get(product_type, ("•", product_type))
-            result_text += f"{emoji} {title}\n"
-            result_text += "--------------------\n"
-            for product in products:
-                result_text += f"• {product.name} — {product.brand}\n"
-                result_text += f"  💰 {product.price:.0f} руб.\n"
-                if product.description:
-                    result_text += f"  📝 {product.description}\n"
-                result_text += "\n"
 
-    if not recommendations:
-        result_text += "😕 Пока ничего не нашлось. Попробуй другие ответы.\n\n"
+async def handle_stateless_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
 
-    result_text += "--------------------\n"
-    result_text += "🔄 Хочешь еще раз? Нажми /quiz"
+    decoded = decode_answers(query.data)
+    if decoded is None:
+        return
+    digits, answers = decoded
 
-    await query.edit_message_text(result_text)
+    if len(answers) < len(QUESTIONS):
+        await query.edit_message_text(question_text(answers), reply_markup=stateless_keyboard(digits))
+        return
 
-    return ConversationHandler.END
+    await query.edit_message_text(await recommend(answers))
 
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Ок, отменил. Нажми /start или /quiz.")
     return ConversationHandler.END
-
@@ -1,70 +1,486 @@
+import argparse
+import hashlib
 import json
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from itertools import islice
 from pathlib import Path
+
+from sqlalchemy import bindparam, insert, select, update
+
 from database import (
-    engine, SessionLocal, init_db,
-    Highlighter, Lipstick, LipGloss, Foundation, Eyeshadow, Mascara, Blush, Eyeliner
+    engine, SessionLocal, init_db, PRODUCT_MODELS, PrecomputedRecommendation,
+    Product, ProductAttribute, IngestCheckpoint, CatalogSource, attribute_rows, bump_catalog_versions,
+    dirty_categories, mark_catalog_dirty, pending_catalog_version,
 )
+from catalog_engine import CATALOG_SNAPSHOT, write_snapshot
+from feeds import FeedError, file_digest, iter_products, parse_feed, validate_product
+from recommendations import build_recommendation_table
+
+# Колонки products, которые заполняются из JSON
+PRODUCT_FIELDS = [
+    c.name for c in Product.__table__.columns if c.name not in ("id", "category", "content_hash", "source")
+]
+BATCH_SIZE = 1000
+DELETE_CHUNK_SIZE = 500
+PROGRESS_INTERVAL = 5.0
+MAX_REPORTED_ERRORS = 20
+
+LoadStats = namedtuple("LoadStats", ["inserted", "updated", "skipped", "deleted", "elapsed"])
+
+
+def content_hash(product_data):
+    content = {field: product_data.get(field) for field in PRODUCT_FIELDS}
+    encoded = json.dumps(content, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class CategoryWriter:
+    """Пакетная запись продуктов одной категории из одного файла как диффа к тому,
+    что уже в базе.
+
+    Ключи (name, brand), хэши содержимого и источники загруженных продуктов
+    читаются одним запросом. Новые продукты вставляются, продукты с другим хэшем
+    или из другого файла обновляются целиком, одинаковые пропускаются; все
+    пакетами executemany. Пакет с изменениями помечает категорию в
+    catalog_versions в той же транзакции.
+    """
+
+    def __init__(self, db, product_type: str, source: str):
+        self.db = db
+        self.product_type = product_type
+        self.source = source
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+        self.deleted = 0
+        self.seen = set()
+        self._marked_dirty = False
+        # счетчики на момент последнего commit() — то, что точно осталось в базе
+        self._committed = (0, 0, 0, 0)
+
+        products = Product.__table__
+        self.existing = {
+            (row.name, row.brand): {"id": row.id, "content_hash": row.content_hash, "source": row.source}
+            for row in db.execute(
+                select(products.c.id, products.c.name, products.c.brand, products.c.content_hash, products.c.source)
+                .where(products.c.category == product_type)
+            )
+        }
+
+    def mark_seen(self, product_data):
+        """Запись уже загружена в прошлый раз (продолжение загрузки)."""
+        self.seen.add((product_data["name"], product_data["brand"]))
+
+    def write_batch(self, batch):
+        products = Product.__table__
+        inserts = {}
+        updates = {}
+
+        for product_data in batch:
+            key = (product_data["name"], product_data["brand"])
+            self.seen.add(key)
+            values = {field: product_data.get(field) for field in PRODUCT_FIELDS}
+            values["content_hash"] = content_hash(product_data)
+            values["source"] = self.source
+
+            existing = self.existing.get(key)
+            if existing is None:
+                inserts[key] = {"category": self.product_type, **values}
+            elif existing["content_hash"] != values["content_hash"] or existing["source"] != self.source:
+                # продукт из другого файла переходит к этому: его удалит только этот файл
+                existing["content_hash"] = values["content_hash"]
+                existing["source"] = self.source
+                updates[existing["id"]] = {"_id": existing["id"], **values}
+            else:
+                self.skipped += 1
+
+        attributes = []
+        if inserts:
+            statement = insert(products).returning(products.c.id, products.c.name, products.c.brand)
+            for row in self.db.execute(statement, list(inserts.values())):
+                values = inserts[(row.name, row.brand)]
+                self.existing[(row.name, row.brand)] = {
+                    "id": row.id, "content_hash": values["content_hash"], "source": self.source,
+                }
+                attributes.extend(attribute_rows(row.id, values))
+            self.inserted += len(inserts)
+
+        if updates:
+            fields = PRODUCT_FIELDS + ["content_hash", "source"]
+            self.db.execute(
+                update(products)
+                .where(products.c.id == bindparam("_id"))
+                .values({field: bindparam(field) for field in fields}),
+                list(updates.values()),
+            )
+            self.db.execute(
+                ProductAttribute.__table__.delete().where(ProductAttribute.product_id.in_(list(updates)))
+            )
+            for product_id, values in updates.items():
+                attributes.extend(attribute_rows(product_id, values))
+            self.updated += len(updates)
+
+        if attributes:
+            self.db.execute(insert(ProductAttribute.__table__), attributes)
+        if inserts or updates:
+            self._mark_dirty()
+
+    def delete_missing(self):
+        """Удаляет продукты этого файла, которых в нем больше нет.
+
+        Продукты категории из других файлов (фиды партнеров через --file) и
+        загруженные до появления колонки source не трогаются.
+        """
+        missing = [
+            key for key, existing in self.existing.items()
+            if key not in self.seen and existing["source"] == self.source
+        ]
+        ids = [self.existing.pop(key)["id"] for key in missing]
+
+        for start in range(0, len(ids), DELETE_CHUNK_SIZE):
+            chunk = ids[start:start + DELETE_CHUNK_SIZE]
+            self.db.execute(ProductAttribute.__table__.delete().where(ProductAttribute.product_id.in_(chunk)))
+            self.db.execute(Product.__table__.delete().where(Product.__table__.c.id.in_(chunk)))
+        if ids:
+            self._mark_dirty()
+        self.deleted += len(ids)
+
+    def _mark_dirty(self):
+        # отметка коммитится с первым же пакетом и до пересчета подборок не снимается
+        if not self._marked_dirty:
+            mark_catalog_dirty(self.db, self.product_type)
+            self._marked_dirty = True
+
+    def commit(self):
+        self.db.commit()
+        self._committed = (self.inserted, self.updated, self.skipped, self.deleted)
+
+    def stats(self, elapsed: float):
+        return LoadStats(self.inserted, self.updated, self.skipped, self.deleted, elapsed)
 
-PRODUCT_MODELS = {
-    "highlighter": Highlighter,
-    "lipstick": Lipstick,
-    "lip_gloss": LipGloss,
-    "foundation": Foundation,
-    "eyeshadow": Eyeshadow,
-    "mascara": Mascara,
-    "blush": Blush,
-    "eyeliner": Eyeliner,
-}
+    def committed_stats(self, elapsed: float):
+        """Статистика без пакетов, откаченных после ошибки."""
+        return LoadStats(*self._committed, elapsed)
 
 
-def load_json_data(file_path: str, product_type: str):
+def _source_unchanged(db, source: str, product_type: str, file_hash: str):
+    """Файл тот же, и категорию после его загрузки никто не менял."""
+    loaded = db.get(CatalogSource, source)
+    return (
+        loaded is not None
+        and loaded.product_type == product_type
+        and loaded.file_hash == file_hash
+        and loaded.category_version == pending_catalog_version(db, product_type)
+    )
+
+
+def _finish_source(db, writer, source: str, file_hash: str, delete_missing: bool):
+    """Завершает загрузку файла: удаления, хэш файла и версия категории после него."""
+    if delete_missing:
+        writer.delete_missing()
+
+    version = pending_catalog_version(db, writer.product_type)
+    loaded = db.get(CatalogSource, source)
+    if loaded is None:
+        db.add(CatalogSource(
+            source=source, product_type=writer.product_type, file_hash=file_hash, category_version=version,
+        ))
+    else:
+        loaded.product_type = writer.product_type
+        loaded.file_hash = file_hash
+        loaded.category_version = version
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _load_checkpoint(db, source, product_type, file_stat):
+    checkpoint = db.get(IngestCheckpoint, source)
+    if checkpoint is not None and (
+        checkpoint.product_type != product_type
+        or checkpoint.file_size != file_stat.st_size
+        or checkpoint.file_mtime != file_stat.st_mtime
+    ):
+        # файл изменился с прошлой попытки — начинаем сначала
+        db.delete(checkpoint)
+        checkpoint = None
+
+    if checkpoint is None:
+        checkpoint = IngestCheckpoint(
+            source=source,
+            product_type=product_type,
+            file_size=file_stat.st_size,
+            file_mtime=file_stat.st_mtime,
+            records_committed=0,
+        )
+        db.add(checkpoint)
+    return checkpoint
+
+
+def load_json_data(
+    file_path: str,
+    product_type: str,
+    batch_size: int = BATCH_SIZE,
+    resume: bool = True,
+    delete_missing: bool = True,
+    force: bool = False,
+):
+    """Загружает JSON-массив или NDJSON потоково, пакетами по batch_size записей.
+
+    Каждый пакет коммитится вместе с номером последней записи, поэтому
+    прерванную загрузку того же файла можно продолжить с места остановки.
+    Файл, хэш которого не изменился с прошлой загрузки, пропускается целиком.
+    """
     db = SessionLocal()
+    started = time.perf_counter()
+    writer = None
     
     try:
-        model_class = PRODUCT_MODELS.get(product_type)
-        if not model_class:
+        if product_type not in PRODUCT_MODELS:
             print(f"Неизвестный тип продукта: {product_type}")
-            return
-        
-        with open(file_path, 'r', encoding='utf-8') as f:
-            products = json.load(f)
-        
-        loaded_count = 0
-        for product_data in products:
-            existing = db.query(model_class).filter_by(
-                name=product_data['name'],
-                brand=product_data['brand']
-            ).first()
-            
-            if existing:
-                changed = False
-                for k in ["hair_color", "face_shape"]:
-                    if k in product_data:
-                        if getattr(existing, k, None) != product_data[k]:
-                            setattr(existing, k, product_data[k])
-                            changed = True
-
-                if changed:
-                    loaded_count += 1
-                else:
-                    print(f"Продукт {product_data['name']} уже существует, пропускаем")
-                continue
-            
-            product = model_class(**product_data)
-            db.add(product)
-            loaded_count += 1
-        
-        db.commit()
-        print(f"✓ Загружено {loaded_count} продуктов типа '{product_type}' из {file_path}")
+            return LoadStats(0, 0, 0, 0, 0.0)
+
+        source = str(Path(file_path).resolve())
+        file_hash = file_digest(file_path)
+        if not force and _source_unchanged(db, source, product_type, file_hash):
+            print(f"  {file_path} не изменился, пропускаем")
+            return LoadStats(0, 0, 0, 0, time.perf_counter() - started)
+
+        checkpoint = _load_checkpoint(db, source, product_type, os.stat(file_path))
+        if not resume:
+            checkpoint.records_committed = 0
+        if checkpoint.records_committed:
+            print(f"  продолжаем с записи {checkpoint.records_committed + 1}")
+
+        writer = CategoryWriter(db, product_type, source)
+        records = checkpoint.records_committed
+        invalid = 0
+        last_report = started
+
+        products = iter_products(file_path)
+        # уже закоммиченные записи не пишем повторно, но помним их ключи,
+        # чтобы не удалить эти продукты как отсутствующие в файле
+        for product_data in islice(products, checkpoint.records_committed):
+            try:
+                writer.mark_seen(validate_product(product_data))
+            except FeedError:
+                pass
+
+        for batch in _batches(products, batch_size):
+            valid = []
+            for offset, product_data in enumerate(batch, records + 1):
+                try:
+                    valid.append(validate_product(product_data))
+                except FeedError as e:
+                    invalid += 1
+                    if invalid <= MAX_REPORTED_ERRORS:
+                        print(f"  запись {offset} пропущена: {e}")
+
+            writer.write_batch(valid)
+            records += len(batch)
+            checkpoint.records_committed = records
+            writer.commit()
+
+            now = time.perf_counter()
+            if now - last_report >= PROGRESS_INTERVAL:
+                print(f"  обработано {records} записей ({records / (now - started):.0f} в секунду)")
+                last_report = now
+
+        _finish_source(db, writer, source, file_hash, delete_missing)
+        if checkpoint in db.new:
+            # пустой фид: ни одного пакета, отметка так и не попала в базу
+            db.expunge(checkpoint)
+        else:
+            db.delete(checkpoint)
+        writer.commit()
+
+        stats = writer.stats(time.perf_counter() - started)
+        print(
+            f"✓ '{product_type}' из {file_path}: добавлено {stats.inserted}, "
+            f"обновлено {stats.updated}, удалено {stats.deleted}, без изменений {stats.skipped} "
+            f"за {stats.elapsed:.2f} с"
+        )
+        if invalid:
+            print(f"  отклонено некорректных записей: {invalid}")
+        return stats
         
     except Exception as e:
         db.rollback()
         print(f"✗ Ошибка при загрузке {file_path}: {e}")
+        # уже закоммиченные пакеты остаются в базе, и в статистике только они
+        if writer is None:
+            return LoadStats(0, 0, 0, 0, time.perf_counter() - started)
+        return writer.committed_stats(time.perf_counter() - started)
+    finally:
+        db.close()
+
+
+def _write_parsed(product_type: str, products, source: str, file_hash: str, batch_size: int, write_lock,
+                  delete_missing: bool = True):
+    db = SessionLocal()
+    started = time.perf_counter()
+
+    try:
+        writer = CategoryWriter(db, product_type, source)
+        for batch in _batches(products, batch_size):
+            with write_lock:
+                writer.write_batch(batch)
+                writer.commit()
+        with write_lock:
+            _finish_source(db, writer, source, file_hash, delete_missing)
+            writer.commit()
+        return writer.stats(time.perf_counter() - started)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def load_parallel(files, workers: int, batch_size: int = BATCH_SIZE, force: bool = False,
+                  delete_missing: bool = True):
+    """Разбирает файлы в пуле процессов и пишет их параллельно, по сессии на файл.
+
+    files: список (путь, тип продукта). SQLite допускает только одного
+    писателя, поэтому для него транзакции записи выполняются по очереди;
+    разбор и проверка файлов при этом все равно идут параллельно.
+    """
+    write_lock = threading.Lock() if engine.dialect.name == "sqlite" else nullcontext()
+    results = []
+
+    hashes = {}
+    db = SessionLocal()
+    try:
+        for file_path, product_type in files:
+            source = str(Path(file_path).resolve())
+            file_hash = file_digest(file_path)
+            if not force and _source_unchanged(db, source, product_type, file_hash):
+                print(f"  {file_path} не изменился, пропускаем")
+                continue
+            hashes[file_path] = (source, file_hash)
+    finally:
+        db.close()
+
+    with ProcessPoolExecutor(max_workers=workers) as parsers, \
+            ThreadPoolExecutor(max_workers=workers) as writers:
+        parse_futures = {
+            parsers.submit(parse_feed, str(file_path), MAX_REPORTED_ERRORS): (file_path, product_type)
+            for file_path, product_type in files
+            if file_path in hashes
+        }
+        write_futures = {}
+        for future in as_completed(parse_futures):
+            file_path, product_type = parse_futures[future]
+            try:
+                parsed = future.result()
+            except Exception as e:
+                print(f"✗ Ошибка при разборе {file_path}: {e}")
+                continue
+            for error in parsed.errors:
+                print(f"  {file_path}: {error}")
+            source, file_hash = hashes[file_path]
+            write_future = writers.submit(
+                _write_parsed, product_type, parsed.products, source, file_hash, batch_size, write_lock,
+                delete_missing,
+            )
+            write_futures[write_future] = (file_path, product_type, parsed)
+
+        for future in as_completed(write_futures):
+            file_path, product_type, parsed = write_futures[future]
+            try:
+                stats = future.result()
+            except Exception as e:
+                print(f"✗ Ошибка при загрузке {file_path}: {e}")
+                continue
+            print(
+                f"✓ '{product_type}' из {file_path}: разбор {parsed.elapsed:.2f} с, "
+                f"запись {stats.elapsed:.2f} с; добавлено {stats.inserted}, "
+                f"обновлено {stats.updated}, удалено {stats.deleted}, без изменений {stats.skipped}, "
+                f"отклонено {parsed.invalid}"
+            )
+            results.append((stats, len(parsed.products) + parsed.invalid))
+
+    return results
+
+
+def rebuild_recommendations(force: bool = False):
+    """Пересчитывает подборки, если есть категории с неопубликованными изменениями.
+
+    Решение принимается по отметкам в catalog_versions, а не по счетчикам
+    этого запуска: изменения прерванной загрузки тоже будут опубликованы.
+    Версии категорий увеличиваются в той же транзакции, что и пересчет:
+    бот не может увидеть новую версию вместе со старыми подборками.
+    """
+    db = SessionLocal()
+
+    try:
+        categories = dirty_categories(db)
+        if not force and not categories and db.query(PrecomputedRecommendation).first() is not None:
+            return
+
+        print("\nПересчет таблицы подборок...")
+        bump_catalog_versions(db, categories)
+        # build_recommendation_table коммитит новые подборки вместе с версиями
+        rows = build_recommendation_table(db)
+        print(f"✓ Таблица подборок обновлена: {rows} комбинаций ответов")
+        if categories:
+            print(f"  новые версии каталога: {', '.join(categories)}")
+    except Exception as e:
+        db.rollback()
+        print(f"✗ Ошибка при пересчете подборок: {e}")
     finally:
         db.close()
 
 
+def rebuild_snapshot():
+    """Снимок каталога для быстрого старта бота (RECOMMENDER_ENGINE=memory)."""
+    try:
+        started = time.perf_counter()
+        products = write_snapshot(CATALOG_SNAPSHOT)
+        print(f"✓ Снимок каталога записан: {CATALOG_SNAPSHOT} ({products} продуктов, "
+              f"{time.perf_counter() - started:.2f} с)")
+    except Exception as e:
+        print(f"✗ Ошибка при записи снимка каталога: {e}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Загрузка каталога косметики в базу")
+    parser.add_argument("--file", help="файл фида (JSON-массив или NDJSON) вместо data/*.json")
+    parser.add_argument("--type", choices=list(PRODUCT_MODELS), help="категория продуктов в --file")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="записей в одном коммите")
+    parser.add_argument("--no-resume", action="store_true", help="начать загрузку файла сначала")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="число процессов для параллельного разбора файлов (1 — последовательная загрузка)",
+    )
+    parser.add_argument("--force", action="store_true", help="загружать файлы, даже если они не изменились")
+    parser.add_argument(
+        "--delete-missing", action="store_true",
+        help="для --file: удалить продукты, загруженные из этого файла, которых в нем больше нет "
+             "(для data/*.json всегда; продукты других файлов не удаляются)",
+    )
+    args = parser.parse_args()
+    if args.file and not args.type:
+        parser.error("для --file нужно указать --type")
+    return args
+
+
 def main():
+    args = parse_args()
+
     print("Инициализация базы данных...")
     init_db()
     print("✓ База данных инициализирована\n")
@@ -81,14 +497,53 @@ def main():
         "blush.json": "blush",
         "eyeliner.json": "eyeliner",
     }
+    if args.file:
+        data_dir = Path(args.file).parent
+        file_mapping = {Path(args.file).name: args.type}
     
+    started = time.perf_counter()
+    totals = [0, 0, 0, 0]
+    files = []
     for filename, product_type in file_mapping.items():
         file_path = data_dir / filename
         if file_path.exists():
-            print(f"Загрузка {filename}...")
-            load_json_data(str(file_path), product_type)
+            files.append((file_path, product_type))
         else:
             print(f"✗ Файл {filename} не найден")
+
+    records = 0
+    if args.workers > 1:
+        print(f"Параллельная загрузка {len(files)} файлов, процессов: {args.workers}")
+        parallel = load_parallel(
+            files, args.workers, args.batch_size, args.force,
+            delete_missing=not args.file or args.delete_missing,
+        )
+        for stats, file_records in parallel:
+            totals = [total + count for total, count in zip(totals, stats[:4])]
+            records += file_records
+    else:
+        for file_path, product_type in files:
+            print(f"Загрузка {file_path.name}...")
+            stats = load_json_data(
+                str(file_path),
+                product_type,
+                batch_size=args.batch_size,
+                resume=not args.no_resume,
+                delete_missing=not args.file or args.delete_missing,
+                force=args.force,
+            )
+            totals = [total + count for total, count in zip(totals, stats[:4])]
+            records += sum(stats[:3])
+
+    inserted, updated, skipped, deleted = totals
+    elapsed = time.perf_counter() - started
+    print(
+        f"\nИтого: добавлено {inserted}, обновлено {updated}, удалено {deleted}, "
+        f"без изменений {skipped} за {elapsed:.2f} с "
+        f"({records / elapsed if elapsed else 0:.0f} записей в секунду)"
+    )
+    rebuild_recommendations()
+    rebuild_snapshot()
     
     print("\n✓ Загрузка данных завершена!")
 
@@ -0,0 +1,293 @@
+"""Метрики бота в текстовом формате Prometheus.
+
+Включаются настройкой METRICS_PORT (HTTP-эндпоинт /metrics) и/или
+METRICS_DUMP_INTERVAL (периодический вывод в лог). Когда обе выключены,
+обработчики, движок базы и запросы к Bot API не оборачиваются вовсе,
+а observe_* сразу возвращаются.
+"""
+import contextvars
+import functools
+import logging
+import os
+import re
+import threading
+import time
+
+from telegram.request import BaseRequest
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", "0"))
+ENABLED = os.getenv("METRICS_ENABLED", "1" if METRICS_PORT or METRICS_DUMP_INTERVAL else "0") == "1"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+# Уровни каскада подбора: сколько признаков подряд совпало у выбранных продуктов
+DEPTH_LEVELS = {1: "skin_tone", 2: "eye_color", 3: "hair_color", 4: "face_shape", 5: "occasion"}
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # [счетчики по корзинам, сумма, количество]
+                state = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, (list(s[0]), s[1], s[2])) for labels, s in self._values.items())
+        names = self.labelnames + ("le",)
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(names, labels + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(names, labels + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+handler_latency = Histogram(
+    "beautymatch_handler_seconds", "Время работы обработчика апдейта", ("handler",)
+)
+db_statement_latency = Histogram(
+    "beautymatch_db_statement_seconds", "Время выполнения SQL-запроса", ("operation", "table")
+)
+db_statements_per_update = Histogram(
+    "beautymatch_db_statements_per_update", "SQL-запросов на один апдейт", ("handler",), COUNT_BUCKETS
+)
+db_seconds_per_update = Histogram(
+    "beautymatch_db_seconds_per_update", "Суммарное время SQL на один апдейт", ("handler",)
+)
+match_depth = Counter(
+    "beautymatch_match_depth_total",
+    "Подборы по категориям и последнему совпавшему признаку каскада",
+    ("category", "level"),
+)
+api_latency = Histogram(
+    "beautymatch_telegram_api_seconds", "Время вызова Bot API", ("method", "status")
+)
+
+METRICS = [handler_latency, db_statement_latency, db_statements_per_update,
+           db_seconds_per_update, match_depth, api_latency]
+
+# Функции, которые при выгрузке возвращают {имя метрики: значение} из чужих stats()
+_collectors = []
+
+# [число запросов, время] SQL текущего апдейта; задается в обертке обработчика
+_update_sql = contextvars.ContextVar("update_sql", default=None)
+
+
+def register_collector(prefix: str, stats):
+    """stats() -> dict; числовые значения выгружаются как gauge с именем prefix_ключ."""
+    _collectors.append((prefix, stats))
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for prefix, stats in _collectors:
+        try:
+            values = stats()
+        except Exception:
+            logger.exception("Не удалось собрать метрики %s", prefix)
+            continue
+        for key, value in values.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f"beautymatch_{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', key)}"
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def instrument_handler(callback, name: str = None):
+    """Оборачивает обработчик замером времени; без метрик возвращает его как есть."""
+    if not ENABLED:
+        return callback
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def timed(update, context):
+        sql = [0, 0.0]
+        token = _update_sql.set(sql)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            handler_latency.observe(time.perf_counter() - started, name)
+            db_statements_per_update.observe(sql[0], name)
+            db_seconds_per_update.observe(sql[1], name)
+            _update_sql.reset(token)
+
+    return timed
+
+
+_TABLE_PATTERN = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+\"?(\w+)", re.IGNORECASE)
+_SUBQUERY_PATTERN = re.compile(r"\([^()]*\)")
+
+
+@functools.lru_cache(maxsize=1024)
+def _statement_labels(statement: str):
+    """(операция, основная таблица); подзапросы в скобках при поиске таблицы пропускаются."""
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+    outer, previous = statement, None
+    while outer != previous:
+        previous, outer = outer, _SUBQUERY_PATTERN.sub("", outer)
+    match = _TABLE_PATTERN.search(outer)
+    return operation, match.group(1) if match else ""
+
+
+def instrument_engine(engine):
+    """Замеры каждого SQL-запроса через события движка SQLAlchemy."""
+    if not ENABLED:
+        return
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["metrics_started"].pop()
+        elapsed = time.perf_counter() - started
+        db_statement_latency.observe(elapsed, *_statement_labels(statement))
+        sql = _update_sql.get()
+        if sql is not None:
+            sql[0] += 1
+            sql[1] += elapsed
+
+
+def observe_depths(depths):
+    """depths: {категория: уровень каскада 1..5}."""
+    if not ENABLED:
+        return
+    for category, level in depths.items():
+        match_depth.inc(category, DEPTH_LEVELS.get(level, str(level)))
+
+
+class InstrumentedRequest(BaseRequest):
+    """Обертка над BaseRequest, которая замеряет каждый вызов Bot API."""
+
+    def __init__(self, request: BaseRequest):
+        self._request = request
+
+    @property
+    def read_timeout(self):
+        return self._request.read_timeout
+
+    async def initialize(self):
+        await self._request.initialize()
+
+    async def shutdown(self):
+        await self._request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        status = "error"
+        try:
+            code, payload = await self._request.do_request(
+                url, method, request_data,
+                read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+            )
+            status = str(code)
+            return code, payload
+        finally:
+            api_latency.observe(time.perf_counter() - started, api_method, status)
+
+
+def _dump_loop(interval: float):
+    while True:
+        time.sleep(interval)
+        logger.info("Метрики:\n%s", render())
+
+
+def start(port: int = METRICS_PORT, dump_interval: float = METRICS_DUMP_INTERVAL):
+    """Запускает эндпоинт /metrics и/или периодический вывод в лог в фоновых потоках."""
+    server = None
+    if ENABLED and port:
+        # http.server нужен только с эндпоинтом, поэтому импортируется здесь
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((METRICS_LISTEN, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        logger.info("Метрики: http://%s:%d/metrics", METRICS_LISTEN, port)
+    if ENABLED and dump_interval > 0:
+        threading.Thread(target=_dump_loop, args=(dump_interval,), name="metrics-dump", daemon=True).start()
+    return server
@@ -0,0 +1,254 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+STATE_PATH = Path(__file__).parent / "bot_state.db"
+
+# sqlite — файл SQLite в режиме WAL, redis — общий Redis для нескольких воркеров, none — без сохранения
+PERSISTENCE = os.getenv("PERSISTENCE", "sqlite")
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", str(STATE_PATH))
+PERSISTENCE_REDIS_URL = os.getenv("PERSISTENCE_REDIS_URL", "redis://localhost:6379/0")
+# Как часто накопленные изменения пишутся в хранилище, секунд
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", "5"))
+
+
+class SQLiteStore:
+    """Ключ-значение поверх SQLite в режиме WAL; все записи пачки — одна транзакция."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS bot_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.commit()
+
+    def load_all(self):
+        with self._lock:
+            return dict(self._conn.execute("SELECT key, value FROM bot_state"))
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM bot_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def write_many(self, values, deleted):
+        with self._lock, self._conn:
+            if values:
+                self._conn.executemany(
+                    "INSERT INTO bot_state (key, value) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    values.items(),
+                )
+            if deleted:
+                self._conn.executemany("DELETE FROM bot_state WHERE key = ?", ((key,) for key in deleted))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisStore:
+    """Ключ-значение в одном хэше Redis.
+
+    Подходит любой клиент с методами hgetall/hget/hset/hdel и pipeline
+    (redis-py, fakeredis и т. п.).
+    """
+
+    def __init__(self, client, name: str = "beautymatch:bot_state"):
+        self._client = client
+        self._name = name
+
+    @classmethod
+    def from_url(cls, url: str):
+        import redis
+
+        return cls(redis.Redis.from_url(url, decode_responses=True))
+
+    def load_all(self):
+        return {_text(k): _text(v) for k, v in self._client.hgetall(self._name).items()}
+
+    def get(self, key: str):
+        value = self._client.hget(self._name, key)
+        return None if value is None else _text(value)
+
+    def write_many(self, values, deleted):
+        pipeline = self._client.pipeline()
+        if values:
+            pipeline.hset(self._name, mapping=values)
+        if deleted:
+            pipeline.hdel(self._name, *deleted)
+        pipeline.execute()
+
+    def close(self):
+        close = getattr(self._client, "close", None)
+        if close is not None:
+            close()
+
+
+def _text(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def _conversation_key(key):
+    return json.dumps(list(key), ensure_ascii=False)
+
+
+class StorePersistence(BasePersistence):
+    """Persistence для python-telegram-bot поверх SQLiteStore или RedisStore.
+
+    Изменения копятся в памяти и пишутся в хранилище одной пачкой, поэтому
+    нажатие кнопки не добавляет запрос к хранилищу. Частоту записи задает
+    update_interval. Для общего хранилища (Redis) user_data и chat_data
+    перечитываются перед обработкой апдейта, поэтому их видят все воркеры;
+    состояние ConversationHandler python-telegram-bot читает только при
+    старте, так что без «липкой» маршрутизации используйте QUIZ_MODE=stateless.
+    """
+
+    def __init__(self, store, update_interval: float = PERSISTENCE_FLUSH_INTERVAL, shared: bool = False):
+        super().__init__(
+            store_data=PersistenceInput(callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+        self.shared = shared
+        self._loaded = None
+        self._pending = {}
+        self._deleted = set()
+        self._write_task = None
+
+    def _data(self):
+        if self._loaded is None:
+            self._loaded = self.store.load_all()
+        return self._loaded
+
+    def _read(self, key, default):
+        value = self._data().get(key)
+        return default if value is None else json.loads(value)
+
+    def _by_prefix(self, prefix: str):
+        return {
+            int(key[len(prefix):]): json.loads(value)
+            for key, value in self._data().items()
+            if key.startswith(prefix)
+        }
+
+    def _set(self, key, value):
+        encoded = json.dumps(value, ensure_ascii=False)
+        self._data()[key] = encoded
+        self._pending[key] = encoded
+        self._deleted.discard(key)
+        self._schedule_write()
+
+    def _delete(self, key):
+        self._data().pop(key, None)
+        self._pending.pop(key, None)
+        self._deleted.add(key)
+        self._schedule_write()
+
+    def _schedule_write(self):
+        # Application вызывает update_* для всех изменений за интервал подряд;
+        # запись откладывается до конца этого цикла и уходит одной пачкой
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.get_running_loop().create_task(self._write_pending())
+
+    async def _write_pending(self):
+        await asyncio.sleep(0)
+        # изменения, пришедшие во время записи, уходят следующей пачкой этой же задачей:
+        # _schedule_write видит ее незавершенной и новую не создает
+        while self._pending or self._deleted:
+            values, deleted = self._pending, self._deleted
+            self._pending, self._deleted = {}, set()
+            await asyncio.to_thread(self.store.write_many, values, deleted)
+
+    async def get_user_data(self):
+        return self._by_prefix("user:")
+
+    async def get_chat_data(self):
+        return self._by_prefix("chat:")
+
+    async def get_bot_data(self):
+        return self._read("bot", {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        # раньше все разговоры хранились одним значением conversation:{name}
+        legacy = self._read(f"conversation:{name}", None)
+        if legacy is not None:
+            for key, state in legacy.items():
+                self._set(f"conversation:{name}:{key}", state)
+            self._delete(f"conversation:{name}")
+
+        prefix = f"conversation:{name}:"
+        return {
+            tuple(json.loads(key[len(prefix):])): json.loads(state)
+            for key, state in self._data().items()
+            if key.startswith(prefix)
+        }
+
+    async def update_user_data(self, user_id, data):
+        self._set(f"user:{user_id}", data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._set(f"chat:{chat_id}", data)
+
+    async def update_bot_data(self, data):
+        self._set("bot", data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        # по ключу на разговор: запись не растет с числом активных разговоров,
+        # и воркеры с общим Redis не затирают разговоры друг друга
+        store_key = f"conversation:{name}:{_conversation_key(key)}"
+        if new_state is None:
+            self._delete(store_key)
+        else:
+            self._set(store_key, new_state)
+
+    async def drop_user_data(self, user_id):
+        self._delete(f"user:{user_id}")
+
+    async def drop_chat_data(self, chat_id):
+        self._delete(f"chat:{chat_id}")
+
+    async def _refresh(self, key, data):
+        if not self.shared or key in self._pending:
+            return
+        value = await asyncio.to_thread(self.store.get, key)
+        if value is not None:
+            self._data()[key] = value
+            data.clear()
+            data.update(json.loads(value))
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh(f"user:{user_id}", user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh(f"chat:{chat_id}", chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        if self._write_task is not None:
+            await self._write_task
+        await self._write_pending()
+        self.store.close()
+
+
+def build_persistence():
+    """Persistence по настройке PERSISTENCE или None, если сохранение выключено."""
+    if PERSISTENCE == "sqlite":
+        return StorePersistence(SQLiteStore(PERSISTENCE_PATH))
+    if PERSISTENCE == "redis":
+        return StorePersistence(RedisStore.from_url(PERSISTENCE_REDIS_URL), shared=True)
+    return None
@@ -0,0 +1,208 @@
+"""Профилирование работающего бота по запросу.
+
+Запускается сигналом SIGUSR1 (повторный сигнал останавливает досрочно) или
+командой /profile от администратора (ADMIN_IDS). Профиль пишется за
+ограниченное время в PROFILE_DIR:
+
+- sample — семплирование стеков всех потоков по таймеру процессорного времени,
+  результат в формате collapsed stacks (flamegraph.pl, speedscope, inferno);
+- cprofile — cProfile потока event loop, результат в формате pstats
+  (snakeviz, `python -m pstats`).
+
+Пока профилирование не запущено, ничего не выполняется.
+"""
+import asyncio
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", "profiles"))
+# sample или cprofile
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sample")
+PROFILE_DURATION = float(os.getenv("PROFILE_DURATION", "30"))
+PROFILE_MAX_DURATION = float(os.getenv("PROFILE_MAX_DURATION", "300"))
+# Период семплирования стеков, с
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+# Telegram id администраторов через запятую; без них команда /profile не регистрируется
+ADMIN_IDS = [int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()]
+
+MODES = ("sample", "cprofile")
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Снимает стеки всех потоков и считает одинаковые.
+
+    Если профилирование запущено в главном потоке (там работает event loop
+    run_polling), замер идет по таймеру процессорного времени SIGPROF: обработчик
+    сигнала выполняется между инструкциями главного потока и видит его
+    настоящий стек. Поток-семплер в этом случае почти всегда просыпался бы,
+    когда event loop ждет в select, и не видел бы работу, которая держит GIL.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = 0
+        # (id потока, стек) -> число замеров; имена потоков подставляются в stop()
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        self._previous_handler = None
+        self._main_id = threading.main_thread().ident
+
+    def start(self):
+        if hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread():
+            self._previous_handler = signal.signal(signal.SIGPROF, self._on_signal)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+            return
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def _on_signal(self, signum, frame):
+        self._sample({self._main_id: frame})
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample({})
+
+    def _sample(self, frames):
+        # Вызывается из обработчика сигнала: никаких блокировок (threading.enumerate
+        # берет нереентерабельный _active_limbo_lock), только кадры и словари
+        own_id = self._thread.ident if self._thread is not None else None
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            frame = frames.get(thread_id, frame)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            self.stacks[thread_id, tuple(reversed(stack))] += 1
+        self.samples += 1
+
+    def stop(self, path: Path):
+        if self._thread is None:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self._previous_handler)
+        else:
+            self._stop.set()
+            self._thread.join()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        collapsed = Counter()
+        for (thread_id, stack), count in self.stacks.items():
+            collapsed[";".join((names.get(thread_id, str(thread_id)),) + stack)] += count
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(collapsed.items()):
+                f.write(f"{stack} {count}\n")
+
+
+class CProfileSession:
+    """cProfile потока, в котором вызван start() (поток event loop)."""
+
+    def __init__(self):
+        import cProfile
+
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self, path: Path):
+        self._profile.disable()
+        self._profile.dump_stats(path)
+
+
+class Profiler:
+    """Один сеанс профилирования за раз; start() и stop() вызываются в потоке event loop."""
+
+    def __init__(self, directory: Path = PROFILE_DIR, interval: float = PROFILE_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.path = None
+        self._session = None
+        self._timer = None
+
+    @property
+    def running(self):
+        return self._session is not None
+
+    def start(self, loop, duration: float = PROFILE_DURATION, mode: str = PROFILE_MODE):
+        """Запускает профилирование на duration секунд и возвращает путь к будущему файлу."""
+        if self.running:
+            raise RuntimeError(f"Профилирование уже идет: {self.path}")
+        if mode not in MODES:
+            raise ValueError(f"Неизвестный режим профилирования: {mode}")
+        duration = min(max(duration, 0.1), PROFILE_MAX_DURATION)
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        suffix = "collapsed" if mode == "sample" else "pstats"
+        self.path = self.directory / f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.{suffix}"
+        self._session = StackSampler(self.interval) if mode == "sample" else CProfileSession()
+        self._session.start()
+        self._timer = loop.call_later(duration, self.stop)
+        logger.info("Профилирование (%s) на %.1f с: %s", mode, duration, self.path)
+        return self.path
+
+    def stop(self):
+        """Останавливает сеанс и пишет профиль; возвращает путь или None, если сеанса не было."""
+        if not self.running:
+            return None
+        session, self._session = self._session, None
+        self._timer.cancel()
+        session.stop(self.path)
+        logger.info("Профиль записан: %s", self.path)
+        return self.path
+
+    def toggle(self, loop):
+        if self.running:
+            return self.stop()
+        return self.start(loop)
+
+    def install_signal_handler(self, loop, signum=getattr(signal, "SIGUSR1", None)):
+        """SIGUSR1 запускает профилирование с настройками по умолчанию или останавливает его."""
+        if signum is None:
+            return False
+        try:
+            loop.add_signal_handler(signum, self.toggle, loop)
+        except (NotImplementedError, RuntimeError):
+            # Windows или event loop не в главном потоке
+            return False
+        return True
+
+
+profiler = Profiler()
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile [секунды] [sample|cprofile] — запустить, /profile stop — остановить досрочно."""
+    args = context.args or []
+    if args[:1] == ["stop"]:
+        path = profiler.stop()
+        await update.message.reply_text(f"Профиль записан: {path}" if path else "Профилирование не запущено.")
+        return
+
+    try:
+        duration = float(args[0]) if args else PROFILE_DURATION
+    except ValueError:
+        await update.message.reply_text("Использование: /profile [секунды] [sample|cprofile] или /profile stop")
+        return
+    mode = args[1] if len(args) > 1 else PROFILE_MODE
+    try:
+        path = profiler.start(asyncio.get_running_loop(), duration, mode)
+    except (RuntimeError, ValueError) as e:
+        await update.message.reply_text(str(e))
+        return
+    await update.message.reply_text(f"Профилирование запущено, результат будет в {path}")
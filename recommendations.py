@@ -0,0 +1,424 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product as cartesian_product
+from types import MappingProxyType
+
+import metrics
+from cache import TTLCache
+from catalog_types import PRODUCT_TYPES
+
+# SQLAlchemy и модели из database.py импортируются внутри функций, которые ходят
+# в базу: бот, запущенный со снимка каталога (catalog_engine.py), обходится без них
+
+logger = logging.getLogger(__name__)
+
+
+EYE_COLORS = ["карие", "зеленые", "голубые", "серые", "темные"]
+SKIN_TONES = ["светлый", "средний", "темный"]
+HAIR_COLORS = ["блондин", "русые", "шатен", "брюнет", "рыжие"]
+FACE_SHAPES = ["овальное", "квадратное", "круглое", "треугольное"]
+OCCASIONS = [
+    "повседневный",
+    "офисный",
+    "вечерний",
+    "особый",
+    "летний",
+    "натуральный",
+    "осенний",
+    "зимний",
+]
+
+# Порядок важности признаков в каскаде: сначала отбрасывается повод,
+# затем форма лица, цвет волос и цвет глаз. Тон кожи обязателен.
+ANSWER_FIELDS = ("skin_tone", "eye_color", "hair_color", "face_shape", "occasion")
+
+ANSWER_SPACE = {
+    "skin_tone": SKIN_TONES,
+    "eye_color": EYE_COLORS,
+    "hair_color": HAIR_COLORS,
+    "face_shape": FACE_SHAPES,
+    "occasion": OCCASIONS,
+}
+
+MAX_PRODUCTS_PER_TYPE = 2
+
+ProductCard = namedtuple("ProductCard", ["id", "name", "brand", "price", "description"])
+
+
+def answer_key(skin_tone, eye_color, hair_color, face_shape, occasion):
+    return "|".join((skin_tone, eye_color, hair_color, face_shape, occasion))
+
+
+def match_depth(product, answers):
+    """Сколько признаков подряд (в порядке ANSWER_FIELDS) совпало у продукта."""
+    depth = 0
+    for field, value in zip(ANSWER_FIELDS, answers):
+        if value not in (getattr(product, field) or ()):
+            break
+        depth += 1
+    return depth
+
+
+def pick_recommendations(products_by_type, answers, depth_of=match_depth):
+    """Повторяет каскад get_products_by_preferences без обращений к базе.
+
+    products_by_type: {тип продукта: продукты в порядке id}.
+    depth_of: функция (продукт, ответы) -> глубина совпадения.
+    """
+    recommendations = {}
+    for product_type in PRODUCT_TYPES:
+        scored = [(depth_of(p, answers), p) for p in products_by_type.get(product_type, ())]
+        best = max((depth for depth, _ in scored), default=0)
+        if best:
+            products = [p for depth, p in scored if depth == best]
+            recommendations[product_type] = products[:MAX_PRODUCTS_PER_TYPE]
+    return recommendations
+
+
+def to_card(product):
+    return ProductCard(product.id, product.name, product.brand, product.price, product.description)
+
+
+def _group_by_type(products):
+    products_by_type = {}
+    for product in products:
+        products_by_type.setdefault(product.category, []).append(product)
+    return products_by_type
+
+
+def build_recommendation_table(db):
+    """Пересчитывает подборки для всего пространства ответов квиза."""
+    # Битовые маски вместо перебора продуктов: на больших каталогах это
+    # единственный способ пересчитать 2400 комбинаций за разумное время
+    from catalog_engine import load_catalog
+    from database import PrecomputedRecommendation
+
+    catalog = load_catalog(db.connection())
+
+    rows = []
+    for answers in cartesian_product(*(ANSWER_SPACE[field] for field in ANSWER_FIELDS)):
+        depths = {}
+        recommendations = catalog.recommend(*answers, depths=depths)
+        payload = {
+            product_type: [list(card) for card in cards]
+            for product_type, cards in recommendations.items()
+        }
+        # уровень каскада по категориям — для метрик; типов продуктов с "_" нет
+        payload["_depths"] = depths
+        rows.append({"answer_key": answer_key(*answers), "payload": payload})
+
+    db.query(PrecomputedRecommendation).delete()
+    db.bulk_insert_mappings(PrecomputedRecommendation, rows)
+    db.commit()
+    return len(rows)
+
+
+def _has_attribute(field, value):
+    from sqlalchemy import exists
+    from database import Product, ProductAttribute
+
+    return exists().where(
+        ProductAttribute.product_id == Product.id,
+        ProductAttribute.attr == field,
+        ProductAttribute.value == value,
+    )
+
+
+def _query_ranked(db, skin_tone, eye_color, hair_color, face_shape, occasion, depths=None):
+    """Один запрос вместо каскада: все кандидаты по тону кожи во всех категориях.
+
+    Глубина совпадения считается в SQL по индексу product_attributes,
+    а выбор лучших делает pick_recommendations, поэтому результат совпадает
+    с прежним каскадом из пяти запросов на каждую категорию.
+    """
+    from sqlalchemy import and_, case, select
+    from database import Product, ProductAttribute
+
+    answers = (skin_tone, eye_color, hair_color, face_shape, occasion)
+    eye, hair, face, occ = (
+        _has_attribute(field, value) for field, value in zip(ANSWER_FIELDS[1:], answers[1:])
+    )
+    depth = case(
+        (and_(eye, hair, face, occ), 5),
+        (and_(eye, hair, face), 4),
+        (and_(eye, hair), 3),
+        (eye, 2),
+        else_=1,
+    )
+    skin_matches = select(ProductAttribute.product_id).where(
+        ProductAttribute.attr == "skin_tone",
+        ProductAttribute.value == skin_tone,
+    )
+
+    candidates = (
+        select(
+            Product.category,
+            Product.id,
+            Product.name,
+            Product.brand,
+            Product.price,
+            Product.description,
+            depth.label("match_depth"),
+        )
+        .where(Product.id.in_(skin_matches))
+        .order_by(Product.id)
+    )
+
+    recommendations = pick_recommendations(
+        _group_by_type(db.execute(candidates)),
+        answers,
+        depth_of=lambda row, _: row.match_depth,
+    )
+    if depths is not None:
+        depths.update((product_type, rows[0].match_depth) for product_type, rows in recommendations.items())
+    return {product_type: [to_card(row) for row in rows] for product_type, rows in recommendations.items()}
+
+
+def get_products_by_preferences(
+    skin_tone: str,
+    eye_color: str,
+    hair_color: str,
+    face_shape: str,
+    occasion: str,
+):
+    from sqlalchemy import select
+    from database import engine, PrecomputedRecommendation
+
+    # Только чтение: соединение из пула без Session и ORM-объектов
+    with engine.connect() as conn:
+        key = answer_key(skin_tone, eye_color, hair_color, face_shape, occasion)
+        payload = conn.execute(
+            select(PrecomputedRecommendation.payload).where(PrecomputedRecommendation.answer_key == key)
+        ).scalar()
+        if payload is not None:
+            metrics.observe_depths(payload.get("_depths", {}))
+            return {
+                product_type: [ProductCard(*card) for card in payload[product_type]]
+                for product_type in PRODUCT_TYPES
+                if product_type in payload
+            }
+
+        # Таблица еще не построена или ответ вне списка вариантов квиза
+        depths = {}
+        recommendations = _query_ranked(conn, skin_tone, eye_color, hair_color, face_shape, occasion, depths)
+        metrics.observe_depths(depths)
+        return recommendations
+
+
+def warm_up_database():
+    """Импорт моделей, настройка мапперов и первое соединение пула — до первого квиза."""
+    from sqlalchemy.orm import configure_mappers
+    from database import engine
+
+    configure_mappers()
+    with engine.connect() as conn:
+        conn.exec_driver_sql("SELECT 1")
+
+
+class RecommendationExecutor:
+    """Выполняет синхронный подбор в пуле потоков, не блокируя event loop бота.
+
+    max_inflight ограничивает число одновременных задач: остальные запросы
+    ждут своей очереди в корутине, а не копятся в очереди пула.
+    """
+
+    def __init__(self, workers: int, max_inflight: int):
+        self.workers = workers
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.waiting = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="recommend")
+        self._slots = asyncio.Semaphore(max_inflight)
+
+    async def run(self, func, *args):
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.inflight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            # контекст апдейта идет в поток вместе с задачей: метрики SQL относятся к нему
+            call = functools.partial(contextvars.copy_context().run, func, *args)
+            return await loop.run_in_executor(self._executor, call)
+        finally:
+            self.inflight -= 1
+            self._slots.release()
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "max_inflight": self.max_inflight,
+            "inflight": self.inflight,
+            "waiting": self.waiting,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+RECOMMENDER_WORKERS = int(os.getenv("RECOMMENDER_WORKERS", "4"))
+RECOMMENDER_MAX_INFLIGHT = int(os.getenv("RECOMMENDER_MAX_INFLIGHT", str(RECOMMENDER_WORKERS * 2)))
+
+recommendation_executor = RecommendationExecutor(RECOMMENDER_WORKERS, RECOMMENDER_MAX_INFLIGHT)
+
+
+class CatalogWatcher:
+    """Следит за версиями каталога, которые load_data.py увеличивает в базе.
+
+    Проверка идет не чаще раза в interval секунд; при изменении подписчики
+    получают множество изменившихся категорий и сбрасывают свои кэши.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.versions = None
+        # Хэшируемый снимок versions — часть ключа кэшей, зависящих от каталога
+        self.token = ()
+        self._checked_at = float("-inf")
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        self._listeners.append(callback)
+
+    def due(self):
+        return time.monotonic() - self._checked_at >= self.interval
+
+    def prime(self, versions):
+        """Запоминает версии, известные без базы (из снимка каталога); следующая
+        проверка — через interval, и если снимок устарел, подписчики об этом узнают."""
+        with self._lock:
+            self.versions = dict(versions)
+            self.token = tuple(sorted(self.versions.items()))
+            self._checked_at = time.monotonic()
+
+    def check(self):
+        with self._lock:
+            if not self.due():
+                return set()
+            self._checked_at = time.monotonic()
+
+            try:
+                from database import engine, get_catalog_versions
+
+                with engine.connect() as conn:
+                    versions = get_catalog_versions(conn)
+            except Exception:
+                # база недоступна — работаем с тем, что есть, и проверим в следующий раз
+                logger.exception("Не удалось проверить версии каталога")
+                return set()
+
+            previous, self.versions = self.versions, versions
+            self.token = tuple(sorted(versions.items()))
+            if previous is None:
+                return set()
+            changed = {
+                category for category in previous.keys() | versions.keys()
+                if previous.get(category) != versions.get(category)
+            }
+
+        if changed:
+            logger.info("Каталог изменился: %s", ", ".join(sorted(changed)))
+            failed = False
+            for callback in self._listeners:
+                try:
+                    callback(changed)
+                except Exception:
+                    logger.exception("Ошибка подписчика при обновлении каталога")
+                    failed = True
+            if failed:
+                # остаемся на прежних версиях: следующая проверка снова оповестит всех
+                with self._lock:
+                    if self.versions is versions:
+                        self.versions = previous
+                        self.token = tuple(sorted(previous.items()))
+        return changed
+
+
+CATALOG_CHECK_INTERVAL = float(os.getenv("CATALOG_CHECK_INTERVAL", "30"))
+
+catalog_watcher = CatalogWatcher(CATALOG_CHECK_INTERVAL)
+
+
+# Функция подбора, которую использует бот. По умолчанию — запрос к базе;
+# bot.py может подменить ее движком в памяти (см. catalog_engine.py).
+_recommender = get_products_by_preferences
+_recommender_blocking = True
+
+# Подборки, полученные из базы, по набору ответов и версии каталога. Значения —
+# неизменяемые отображения {тип продукта: кортеж ProductCard}, общие для всех
+# запросов; при смене версии каталога кэш очищается.
+RECOMMENDATION_CACHE_SIZE = int(os.getenv("RECOMMENDATION_CACHE_SIZE", "4096"))
+RECOMMENDATION_CACHE_TTL = float(os.getenv("RECOMMENDATION_CACHE_TTL", "600"))
+
+recommendation_cache = TTLCache(RECOMMENDATION_CACHE_SIZE, RECOMMENDATION_CACHE_TTL)
+catalog_watcher.subscribe(lambda categories: recommendation_cache.clear())
+
+# Подборки, которые считаются прямо сейчас: одинаковые одновременные запросы
+# ждут одну задачу, а не занимают по потоку и соединению каждый
+_inflight = {}
+coalesced_requests = 0
+
+
+def freeze_recommendations(recommendations):
+    return MappingProxyType(
+        {product_type: tuple(cards) for product_type, cards in recommendations.items()}
+    )
+
+
+def set_recommender(func, blocking: bool = True):
+    """blocking=False — функция не ходит в базу и вызывается прямо в event loop."""
+    global _recommender, _recommender_blocking
+    _recommender = func
+    _recommender_blocking = blocking
+
+
+async def check_catalog():
+    """Проверяет версии каталога, если подошел срок, не блокируя event loop."""
+    if catalog_watcher.due():
+        await recommendation_executor.run(catalog_watcher.check)
+
+
+async def get_products_by_preferences_async(
+    skin_tone: str,
+    eye_color: str,
+    hair_color: str,
+    face_shape: str,
+    occasion: str,
+):
+    await check_catalog()
+
+    if not _recommender_blocking:
+        return _recommender(skin_tone, eye_color, hair_color, face_shape, occasion)
+
+    global coalesced_requests
+    key = (skin_tone, eye_color, hair_color, face_shape, occasion, catalog_watcher.token)
+    recommendations = recommendation_cache.get(key)
+    if recommendations is not None:
+        return recommendations
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_compute_recommendations(key))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        coalesced_requests += 1
+    # отмена одного ожидающего не должна отменять расчет для остальных
+    return await asyncio.shield(task)
+
+
+async def _compute_recommendations(key):
+    recommendations = freeze_recommendations(await recommendation_executor.run(_recommender, *key[:5]))
+    recommendation_cache.put(key, recommendations)
+    return recommendations
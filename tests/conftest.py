@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# database.py и catalog_engine.py читают настройки при импорте, поэтому
+# временная база и снимок задаются до того, как тесты их импортируют
+_TMP_DIR = Path(tempfile.mkdtemp(prefix="beautymatch-tests-"))
+os.environ["DATABASE_URL"] = f"sqlite:///{_TMP_DIR / 'catalog.db'}"
+os.environ["CATALOG_SNAPSHOT"] = str(_TMP_DIR / "catalog.snapshot")
+os.environ.pop("DB_READ_ONLY", None)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,100 @@
+"""Потоковый разбор фидов: JSON-массив блоками, NDJSON и поврежденные файлы."""
+import io
+import json
+
+import pytest
+
+import feeds
+from feeds import FeedError, iter_products, parse_feed, validate_product
+
+PRODUCT = {
+    "name": "Тушь", "brand": "Бренд", "color": "черный", "skin_tone": ["светлый"],
+    "eye_color": ["карие"], "occasion": ["вечерний"], "price": 990,
+    "description": 'строка с "кавычками", [скобками] и {фигурными}',
+}
+PRODUCTS = [dict(PRODUCT, name=f"Тушь {number}") for number in range(50)]
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # записи гарантированно рвутся на границах блоков
+    monkeypatch.setattr(feeds, "CHUNK_SIZE", 7)
+
+
+def test_json_array_is_parsed_across_chunk_boundaries(tmp_path):
+    path = tmp_path / "feed.json"
+    path.write_text(json.dumps(PRODUCTS, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    assert list(iter_products(path)) == PRODUCTS
+
+
+def test_ndjson_skips_blank_lines(tmp_path):
+    path = tmp_path / "feed.ndjson"
+    lines = [json.dumps(product, ensure_ascii=False) for product in PRODUCTS]
+    path.write_text("\n\n".join(lines) + "\n", encoding="utf-8")
+
+    assert list(iter_products(path)) == PRODUCTS
+
+
+@pytest.mark.parametrize("content", ["[]", "  [ ]\n", ""])
+def test_empty_feed_has_no_products(tmp_path, content):
+    path = tmp_path / "feed.json"
+    path.write_text(content, encoding="utf-8")
+
+    assert list(iter_products(path)) == []
+
+
+def test_truncated_array_raises(tmp_path):
+    path = tmp_path / "feed.json"
+    path.write_text(json.dumps(PRODUCTS, ensure_ascii=False)[:-40], encoding="utf-8")
+
+    with pytest.raises(FeedError):
+        list(iter_products(path))
+
+
+def test_malformed_record_fails_without_reading_the_rest(monkeypatch):
+    monkeypatch.setattr(feeds, "MAX_RECORD_SIZE", 1024)
+    rest = ",".join(json.dumps(product, ensure_ascii=False) for product in PRODUCTS * 20)
+    content = f'[{json.dumps(PRODUCT)}, {{"name": bad}}, {rest}]'
+    f = io.StringIO(content)
+
+    products = feeds._iter_json_array(f)
+    assert next(products) == PRODUCT
+    with pytest.raises(FeedError, match="1024"):
+        next(products)
+    # буфер не дорос до конца файла
+    assert f.tell() < len(content) // 4
+
+
+def test_ndjson_bad_line_reports_line_number(tmp_path):
+    path = tmp_path / "feed.ndjson"
+    path.write_text(json.dumps(PRODUCT) + "\n{oops\n", encoding="utf-8")
+
+    with pytest.raises(FeedError, match="строка 2"):
+        list(iter_products(path))
+
+
+@pytest.mark.parametrize("broken, message", [
+    ({"price": None}, "price"),
+    ({"price": "990"}, "price должно быть числом"),
+    ({"skin_tone": "светлый"}, "skin_tone"),
+    ({"hair_color": None}, None),
+])
+def test_validate_product(broken, message):
+    product = dict(PRODUCT, **broken)
+    if message is None:
+        assert validate_product(product) is product
+    else:
+        with pytest.raises(FeedError, match=message):
+            validate_product(product)
+
+
+def test_parse_feed_counts_invalid_records(tmp_path):
+    path = tmp_path / "feed.json"
+    path.write_text(json.dumps([PRODUCT, {"name": "без полей"}, PRODUCT], ensure_ascii=False), encoding="utf-8")
+
+    parsed = parse_feed(str(path))
+
+    assert parsed.products == [PRODUCT, PRODUCT]
+    assert parsed.invalid == 1
+    assert parsed.errors and parsed.errors[0].startswith("запись 2")
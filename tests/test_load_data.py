@@ -0,0 +1,136 @@
+"""Загрузка фида как диффа: обновления, удаления, пропуск, продолжение и версии каталога."""
+import json
+from pathlib import Path
+
+import pytest
+from sqlalchemy import select
+
+import load_data
+from database import Base, Product, SessionLocal, dirty_categories, engine, get_catalog_versions, init_db
+from load_data import load_json_data, rebuild_recommendations
+
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
+MASCARAS = json.loads((DATA_DIR / "mascara.json").read_text(encoding="utf-8"))
+
+
+def write_feed(path, products):
+    path.write_text(json.dumps(products, ensure_ascii=False), encoding="utf-8")
+    return str(path)
+
+
+def mascara_names():
+    with engine.connect() as conn:
+        return set(conn.execute(select(Product.name).where(Product.category == "mascara")).scalars())
+
+
+def catalog_state():
+    db = SessionLocal()
+    try:
+        return get_catalog_versions(db), dirty_categories(db)
+    finally:
+        db.close()
+
+
+@pytest.fixture(autouse=True)
+def clean_db():
+    Base.metadata.drop_all(bind=engine)
+    init_db()
+    yield
+    Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture
+def feed(tmp_path):
+    path = tmp_path / "mascara.json"
+    write_feed(path, MASCARAS)
+    assert load_json_data(str(path), "mascara").inserted == len(MASCARAS)
+    rebuild_recommendations()
+    return path
+
+
+def test_price_change_updates_one_product(feed):
+    products = [dict(product) for product in MASCARAS]
+    products[0]["price"] += 100
+    write_feed(feed, products)
+
+    stats = load_json_data(str(feed), "mascara")
+
+    assert (stats.inserted, stats.updated, stats.skipped, stats.deleted) == (0, 1, len(MASCARAS) - 1, 0)
+
+
+def test_removed_record_is_deleted(feed):
+    write_feed(feed, MASCARAS[1:])
+
+    stats = load_json_data(str(feed), "mascara")
+
+    assert stats.deleted == 1
+    assert MASCARAS[0]["name"] not in mascara_names()
+
+
+def test_unchanged_file_is_skipped(feed):
+    stats = load_json_data(str(feed), "mascara")
+
+    assert (stats.inserted, stats.updated, stats.skipped, stats.deleted) == (0, 0, 0, 0)
+
+
+def test_file_is_reloaded_after_another_feed_changed_its_category(feed, tmp_path):
+    partner = [dict(MASCARAS[0], price=MASCARAS[0]["price"] + 1)]
+    load_json_data(write_feed(tmp_path / "partner.json", partner), "mascara")
+    rebuild_recommendations()
+
+    stats = load_json_data(str(feed), "mascara")
+
+    assert stats.updated == 1
+
+
+def test_other_feeds_products_are_not_deleted(feed, tmp_path):
+    partner = [dict(MASCARAS[0], name="Partner Mascara")]
+    load_json_data(write_feed(tmp_path / "partner.json", partner), "mascara")
+
+    stats = load_json_data(str(feed), "mascara", force=True)
+
+    assert stats.deleted == 0
+    assert "Partner Mascara" in mascara_names()
+
+
+def test_interrupted_load_resumes_and_publishes_new_version(feed, monkeypatch):
+    versions, _ = catalog_state()
+    products = [dict(product, price=product["price"] + 1) for product in MASCARAS]
+    write_feed(feed, products)
+
+    def crash(*args, **kwargs):
+        raise RuntimeError("прервано")
+
+    monkeypatch.setattr(load_data, "_finish_source", crash)
+    stats = load_json_data(str(feed), "mascara", batch_size=4)
+    assert stats.updated == len(MASCARAS)
+    assert catalog_state() == (versions, ["mascara"])
+
+    monkeypatch.undo()
+    stats = load_json_data(str(feed), "mascara", batch_size=4)
+    assert stats.updated == 0
+    rebuild_recommendations()
+
+    new_versions, dirty = catalog_state()
+    assert new_versions["mascara"] == versions["mascara"] + 1
+    assert dirty == []
+
+
+@pytest.mark.parametrize("content", ["[]", ""])
+def test_empty_feed_loads_cleanly(feed, tmp_path, content):
+    path = tmp_path / "empty.json"
+    path.write_text(content, encoding="utf-8")
+
+    stats = load_json_data(str(path), "mascara", delete_missing=True)
+
+    assert (stats.inserted, stats.updated, stats.deleted) == (0, 0, 0)
+    assert len(mascara_names()) == len(MASCARAS)
+
+
+def test_empty_feed_empties_its_own_products(feed):
+    feed.write_text("[]", encoding="utf-8")
+
+    stats = load_json_data(str(feed), "mascara")
+
+    assert stats.deleted == len(MASCARAS)
+    assert mascara_names() == set()
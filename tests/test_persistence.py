@@ -0,0 +1,82 @@
+"""StorePersistence поверх SQLiteStore: данные переживают перезапуск бота."""
+import asyncio
+import json
+import time
+
+from persistence import SQLiteStore, StorePersistence
+
+
+def reopen(path):
+    return StorePersistence(SQLiteStore(str(path)))
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / "state.db"
+
+    async def save():
+        persistence = reopen(path)
+        await persistence.update_user_data(1, {"skin_tone": "светлый"})
+        await persistence.update_user_data(2, {"skin_tone": "темный"})
+        await persistence.update_chat_data(10, {"lang": "ru"})
+        await persistence.update_bot_data({"started": 1})
+        await persistence.update_conversation("quiz", (10, 1), 3)
+        await persistence.update_conversation("quiz", (10, 2), 1)
+        await persistence.update_conversation("quiz", (10, 2), None)
+        await persistence.drop_user_data(2)
+        await persistence.flush()
+
+    async def load():
+        persistence = reopen(path)
+        return (
+            await persistence.get_user_data(),
+            await persistence.get_chat_data(),
+            await persistence.get_bot_data(),
+            await persistence.get_conversations("quiz"),
+        )
+
+    asyncio.run(save())
+
+    assert asyncio.run(load()) == (
+        {1: {"skin_tone": "светлый"}},
+        {10: {"lang": "ru"}},
+        {"started": 1},
+        {(10, 1): 3},
+    )
+
+
+def test_one_key_per_conversation_and_legacy_map(tmp_path):
+    path = tmp_path / "state.db"
+    store = SQLiteStore(str(path))
+    store.write_many({"conversation:quiz": json.dumps({"[1, 1]": 2})}, set())
+    store.close()
+
+    async def migrate():
+        persistence = reopen(path)
+        conversations = await persistence.get_conversations("quiz")
+        await persistence.flush()
+        return conversations
+
+    assert asyncio.run(migrate()) == {(1, 1): 2}
+    assert SQLiteStore(str(path)).load_all() == {"conversation:quiz:[1, 1]": "2"}
+
+
+def test_changes_during_a_write_are_not_lost(tmp_path):
+    class SlowStore(SQLiteStore):
+        def write_many(self, values, deleted):
+            time.sleep(0.05)
+            super().write_many(values, deleted)
+
+    path = tmp_path / "state.db"
+
+    async def save():
+        persistence = StorePersistence(SlowStore(str(path)))
+        await persistence.update_user_data(1, {"step": 1})
+        await asyncio.sleep(0.01)
+        # первая запись еще идет в потоке
+        await persistence.update_user_data(2, {"step": 2})
+        await asyncio.sleep(0.2)
+        assert persistence._write_task.done()
+
+    asyncio.run(save())
+
+    assert SQLiteStore(str(path)).load_all() == {"user:1": '{"step": 1}', "user:2": '{"step": 2}'}
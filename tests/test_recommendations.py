@@ -0,0 +1,84 @@
+"""Все способы подбора совпадают с исходным каскадом на всем пространстве ответов квиза."""
+from itertools import product as cartesian_product
+from pathlib import Path
+
+import pytest
+from sqlalchemy import select
+
+from catalog_engine import CATALOG_SNAPSHOT, load_catalog, read_snapshot, write_snapshot
+from catalog_types import PRODUCT_TYPES
+from database import Product, engine, init_db
+from load_data import load_json_data, rebuild_recommendations
+from recommendations import (
+    ANSWER_FIELDS, ANSWER_SPACE, MAX_PRODUCTS_PER_TYPE, ProductCard, _query_ranked,
+    get_products_by_preferences,
+)
+
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
+
+ALL_ANSWERS = list(cartesian_product(*(ANSWER_SPACE[field] for field in ANSWER_FIELDS)))
+
+
+def reference_cascade(products_by_type, answers):
+    """Каскад из первой версии бота: все пять признаков, затем без повода,
+    без формы лица и т. д. до одного тона кожи; первые два продукта по id."""
+    recommendations = {}
+    for product_type in PRODUCT_TYPES:
+        for depth in range(len(ANSWER_FIELDS), 0, -1):
+            matched = [
+                product for product in products_by_type.get(product_type, ())
+                if all(
+                    value in (product[field] or ())
+                    for field, value in zip(ANSWER_FIELDS[:depth], answers[:depth])
+                )
+            ]
+            if matched:
+                recommendations[product_type] = [
+                    ProductCard(*(product[field] for field in ProductCard._fields))
+                    for product in matched[:MAX_PRODUCTS_PER_TYPE]
+                ]
+                break
+    return recommendations
+
+
+@pytest.fixture(scope="module")
+def catalog_db():
+    init_db()
+    for product_type in PRODUCT_TYPES:
+        load_json_data(str(DATA_DIR / f"{product_type}.json"), product_type, force=True)
+    rebuild_recommendations(force=True)
+
+    products_by_type = {}
+    with engine.connect() as conn:
+        for row in conn.execute(select(Product.__table__).order_by(Product.id)).mappings():
+            products_by_type.setdefault(row["category"], []).append(row)
+    return products_by_type
+
+
+def test_answer_space_size():
+    assert len(ALL_ANSWERS) == 2400
+
+
+def test_precomputed_table_matches_reference(catalog_db):
+    for answers in ALL_ANSWERS:
+        assert get_products_by_preferences(*answers) == reference_cascade(catalog_db, answers), answers
+
+
+def test_ranked_query_matches_reference(catalog_db):
+    with engine.connect() as conn:
+        for answers in ALL_ANSWERS:
+            assert _query_ranked(conn, *answers) == reference_cascade(catalog_db, answers), answers
+
+
+def test_bitset_catalog_matches_reference(catalog_db):
+    catalog = load_catalog()
+    for answers in ALL_ANSWERS:
+        assert catalog.recommend(*answers) == reference_cascade(catalog_db, answers), answers
+
+
+def test_snapshot_round_trip_matches_reference(catalog_db):
+    write_snapshot(CATALOG_SNAPSHOT)
+    catalog, versions = read_snapshot(CATALOG_SNAPSHOT)
+    assert set(versions) == set(PRODUCT_TYPES)
+    for answers in ALL_ANSWERS:
+        assert catalog.recommend(*answers) == reference_cascade(catalog_db, answers), answers
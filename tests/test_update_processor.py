@@ -0,0 +1,68 @@
+"""ChatOrderedUpdateProcessor: порядок внутри чата и параллельность между чатами."""
+import asyncio
+from types import SimpleNamespace
+
+from update_processor import ChatOrderedUpdateProcessor
+
+
+def update_for(chat_id):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), effective_user=None)
+
+
+async def handle(events, chat_id, number, delay):
+    events.append(("start", chat_id, number))
+    await asyncio.sleep(delay)
+    events.append(("end", chat_id, number))
+
+
+def run_updates(processor, updates, delay=0.01):
+    events = []
+
+    async def main():
+        await asyncio.gather(*(
+            processor.process_update(update_for(chat_id), handle(events, chat_id, number, delay))
+            for chat_id, number in updates
+        ))
+
+    asyncio.run(main())
+    return events
+
+
+def test_updates_of_one_chat_run_in_order_one_at_a_time():
+    updates = [(chat_id, number) for number in range(5) for chat_id in (1, 2, 3)]
+
+    events = run_updates(ChatOrderedUpdateProcessor(8), updates)
+
+    for chat_id in (1, 2, 3):
+        chat_events = [(kind, number) for kind, chat, number in events if chat == chat_id]
+        assert chat_events == [(kind, number) for number in range(5) for kind in ("start", "end")]
+
+
+def test_different_chats_run_concurrently():
+    events = run_updates(ChatOrderedUpdateProcessor(8), [(chat_id, 0) for chat_id in range(4)])
+
+    # все чаты начали до того, как закончился первый
+    assert [kind for kind, _, _ in events[:4]] == ["start"] * 4
+
+
+def test_concurrency_limit_is_respected():
+    processor = ChatOrderedUpdateProcessor(2)
+    running = []
+    peak = []
+
+    async def tracked(chat_id):
+        running.append(chat_id)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(chat_id)
+
+    async def main():
+        await asyncio.gather(*(
+            processor.process_update(update_for(chat_id), tracked(chat_id)) for chat_id in range(6)
+        ))
+
+    asyncio.run(main())
+
+    assert max(peak) == 2
+    assert processor.stats()["processed"] == 6
+    assert processor.stats()["active_chats"] == 0
@@ -0,0 +1,178 @@
+import logging
+import os
+import time
+from collections import Counter
+
+from telegram import Update
+from telegram.ext import (
+    ApplicationHandlerStop,
+    CallbackQueryHandler,
+    CommandHandler,
+    ContextTypes,
+    ConversationHandler,
+    MessageHandler,
+    TypeHandler,
+)
+
+logger = logging.getLogger(__name__)
+
+# Какие типы апдейтов нужны каждому виду обработчиков
+HANDLER_UPDATE_TYPES = (
+    (CommandHandler, {Update.MESSAGE}),
+    (MessageHandler, {Update.MESSAGE}),
+    (CallbackQueryHandler, {Update.CALLBACK_QUERY}),
+)
+
+# Кнопки квиза в сообщении, которое не менялось дольше этого, считаются брошенным опросом
+STALE_CALLBACK_SECONDS = float(os.getenv("STALE_CALLBACK_SECONDS", "1800"))
+
+# Лимит апдейтов на пользователя: RATE_LIMIT_BURST подряд, дальше RATE_LIMIT_PER_SECOND в секунду
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "2"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "6"))
+# Повторное нажатие той же кнопки в том же сообщении в течение этого окна отбрасывается
+DEBOUNCE_SECONDS = float(os.getenv("DEBOUNCE_SECONDS", "2"))
+
+dropped_updates = Counter()
+
+
+class TokenBucketLimiter:
+    """Token bucket на каждый ключ (id пользователя)."""
+
+    # при стольких ключах забываются те, чье ведро уже снова полное
+    PRUNE_SIZE = 10_000
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+
+    def allow(self, key, now: float = None) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic() if now is None else now
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+        if len(self._buckets) > self.PRUNE_SIZE:
+            self._prune(now)
+        return allowed
+
+    def _prune(self, now: float):
+        refill = self.burst / self.rate
+        self._buckets = {
+            key: (tokens, updated)
+            for key, (tokens, updated) in self._buckets.items()
+            if now - updated < refill
+        }
+
+
+class CallbackDebouncer:
+    """Помнит недавно нажатые кнопки, чтобы повторы не запускали обработчик снова."""
+
+    def __init__(self, window: float):
+        self.window = window
+        self._seen = {}
+
+    def is_duplicate(self, key, now: float = None) -> bool:
+        if self.window <= 0:
+            return False
+        now = time.monotonic() if now is None else now
+        seen_at = self._seen.get(key)
+        if seen_at is not None and now - seen_at < self.window:
+            return True
+        self._seen[key] = now
+        if len(self._seen) > TokenBucketLimiter.PRUNE_SIZE:
+            self._seen = {k: t for k, t in self._seen.items() if now - t < self.window}
+        return False
+
+    def forget(self, key):
+        self._seen.pop(key, None)
+
+
+rate_limiter = TokenBucketLimiter(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST)
+callback_debouncer = CallbackDebouncer(DEBOUNCE_SECONDS)
+
+
+def _handler_update_types(handler):
+    if isinstance(handler, ConversationHandler):
+        types = set()
+        children = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            children.extend(state_handlers)
+        for child in children:
+            types |= _handler_update_types(child)
+        return types
+
+    if isinstance(handler, TypeHandler):
+        # TypeHandler используется как фильтр перед обработчиками и сам типы не добавляет
+        return set()
+
+    for handler_class, types in HANDLER_UPDATE_TYPES:
+        if isinstance(handler, handler_class):
+            return set(types)
+
+    # Неизвестный обработчик: не рискуем потерять его апдейты
+    return set(Update.ALL_TYPES)
+
+
+def allowed_updates_for(application):
+    """Минимальный allowed_updates для обработчиков, зарегистрированных в application."""
+    types = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            types |= _handler_update_types(handler)
+    return sorted(types)
+
+
+def _drop(reason: str):
+    dropped_updates[reason] += 1
+    total = sum(dropped_updates.values())
+    if total % 100 == 1:
+        logger.info("Отброшено апдейтов: %s", dict(dropped_updates))
+    raise ApplicationHandlerStop
+
+
+async def limit_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ограничивает частоту апдейтов от пользователя и отбрасывает повторные нажатия;
+    регистрируется в группе -2, до остальных фильтров."""
+    user = update.effective_user
+    query = update.callback_query
+    key = None
+
+    if query is not None and query.message is not None:
+        key = (query.message.chat_id, query.message.message_id, query.data)
+        if callback_debouncer.is_duplicate(key):
+            # та же кнопка уже обрабатывается или только что обработана: ответ был бы тем же
+            await query.answer()
+            _drop("duplicate_callback")
+
+    if user is not None and not rate_limiter.allow(user.id):
+        if key is not None:
+            # отброшенное по лимиту нажатие можно повторить сразу
+            callback_debouncer.forget(key)
+            await query.answer("Слишком часто. Подожди секунду.")
+        _drop("rate_limited")
+
+
+async def drop_stale_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отбрасывает апдейты до ConversationHandler; регистрируется в группе -1."""
+    query = update.callback_query
+    if query is not None:
+        message = query.message
+        if message is None or not query.data:
+            _drop("callback_without_message")
+        # шаги квиза редактируют одно сообщение: date — начало опроса, edit_date — последний ответ
+        last_activity = message.edit_date or message.date
+        if time.time() - last_activity.timestamp() > STALE_CALLBACK_SECONDS:
+            await query.answer("Этот опрос устарел. Нажми /quiz, чтобы начать заново.")
+            _drop("stale_callback")
+        return
+
+    if update.message is None:
+        # апдейт типа, который боту не нужен (например, из старого allowed_updates)
+        _drop("unhandled_type")
+
+
+def drop_stats():
+    return dict(dropped_updates)
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import nullcontext
+
+from telegram.ext import BaseUpdateProcessor
+
+# Сколько апдейтов обрабатывается одновременно; 1 — строго по одному, как раньше
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+# Сколько апдейтов может ждать своей очереди, пока остальные обрабатываются
+UPDATE_BACKLOG = int(os.getenv("UPDATE_BACKLOG", str(max(UPDATE_CONCURRENCY, 1) * 32)))
+
+# По стольким последним апдейтам считаются перцентили ожидания
+WAIT_SAMPLES = 2048
+
+
+def _percentile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, round(q / 100 * (len(ordered) - 1)))]
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов разных чатов с порядком внутри чата.
+
+    Апдейты одного чата выполняются строго по очереди, поэтому состояния
+    ConversationHandler не гоняются друг с другом. Разные чаты обрабатываются
+    параллельно, не больше max_concurrent_updates одновременно. Место в общем
+    лимите занимается только после того, как подошла очередь чата, так что
+    пользователь, который шлет много апдейтов, не блокирует остальных.
+    """
+
+    def __init__(self, max_concurrent_updates: int, backlog: int = UPDATE_BACKLOG):
+        super().__init__(max_concurrent_updates)
+        # семафор базового класса ограничивает принятые апдейты (ждущие + выполняемые),
+        # а число выполняемых одновременно — собственный семафор
+        self._semaphore = asyncio.BoundedSemaphore(max(backlog, max_concurrent_updates))
+        self._running_slots = asyncio.Semaphore(max_concurrent_updates)
+        self._chats = {}
+        self.queued = 0
+        self.running = 0
+        self.max_queued = 0
+        self.processed = 0
+        self.wait_total = 0.0
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+
+    @staticmethod
+    def chat_key(update):
+        chat = getattr(update, "effective_chat", None)
+        if chat is not None:
+            return chat.id
+        user = getattr(update, "effective_user", None)
+        return ("user", user.id) if user is not None else None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.chat_key(update)
+        started = time.perf_counter()
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+
+        chat = None
+        if key is not None:
+            # [замок чата, сколько апдейтов чата ждут или выполняются]
+            chat = self._chats.setdefault(key, [asyncio.Lock(), 0])
+            chat[1] += 1
+
+        dequeued = False
+        try:
+            async with chat[0] if chat is not None else nullcontext():
+                async with self._running_slots:
+                    dequeued = True
+                    self.queued -= 1
+                    waited = time.perf_counter() - started
+                    self.wait_total += waited
+                    self._waits.append(waited)
+                    self.running += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.running -= 1
+                        self.processed += 1
+        finally:
+            if not dequeued:
+                self.queued -= 1
+            if chat is not None:
+                chat[1] -= 1
+                if not chat[1]:
+                    del self._chats[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        waits = sorted(self._waits)
+        return {
+            "max_concurrent_updates": self.max_concurrent_updates,
+            "running": self.running,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "active_chats": len(self._chats),
+            "processed": self.processed,
+            "wait_avg_ms": round(self.wait_total / self.processed * 1000, 3) if self.processed else 0.0,
+            "wait_p50_ms": round(_percentile(waits, 50) * 1000, 3),
+            "wait_p99_ms": round(_percentile(waits, 99) * 1000, 3),
+            "wait_max_ms": round(waits[-1] * 1000, 3) if waits else 0.0,
+        }